@@ -0,0 +1,296 @@
+import copy
+import datetime
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Paths of the API the services use, group names are kind and namespace/name
+ROUTES = [
+    (re.compile(r'^/api/v1/namespaces/(?P<namespace>[^/]+)/persistentvolumeclaims/(?P<name>[^/]+)$'), 'PersistentVolumeClaim'),
+    (re.compile(r'^/api/v1/namespaces/(?P<namespace>[^/]+)/pods/(?P<name>[^/]+)$'), 'Pod'),
+    (re.compile(r'^/api/v1/namespaces/(?P<namespace>[^/]+)/pods$'), 'PodList'),
+    (re.compile(r'^/api/v1/namespaces/(?P<name>[^/]+)$'), 'Namespace'),
+    (re.compile(r'^/api/v1/namespaces$'), 'NamespaceList'),
+    (re.compile(r'^/api/v1/persistentvolumes/(?P<name>[^/]+)$'), 'PersistentVolume'),
+    (re.compile(r'^/api/v1/pods$'), 'PodList'),
+    (re.compile(r'^/api/v1/nodes$'), 'NodeList'),
+    (re.compile(r'^/version/?$'), 'Version'),
+]
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _merge(target: Dict[str, Any], patch: Dict[str, Any]):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def _matches(obj: Dict[str, Any], label_selector: str) -> bool:
+    if not label_selector:
+        return True
+
+    labels = obj['metadata'].get('labels') or {}
+    for requirement in label_selector.split(','):
+        if '!=' in requirement:
+            key, _, value = requirement.partition('!=')
+            if labels.get(key) == value:
+                return False
+            continue
+
+        key, _, value = requirement.partition('=')
+        if labels.get(key) != value:
+            return False
+    return True
+
+
+class FakeCluster:
+    """In-memory objects of a cluster with a resource version history for watches.
+
+    Pods move from Pending to Running after pod_start seconds, once they have
+    no scheduling gates, and to Succeeded after run seconds. A latency in
+    seconds is added to every request."""
+
+    def __init__(self, latency: float = 0.0, pod_start: float = 1.0, run: float = 5.0, gpus: int = 4):
+        self.latency = latency
+        self.pod_start = pod_start
+        self.run = run
+        self.gpus = gpus
+        self.cond = threading.Condition()
+        self.objects: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.events: List[Tuple[int, str, str, Dict[str, Any]]] = []
+        self.resource_version = 0
+        self.requests = 0
+
+    def _record(self, event_type: str, obj: Dict[str, Any]):
+        """Callers hold cond"""
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((self.resource_version, event_type,
+                           obj['kind'], copy.deepcopy(obj)))
+        self.cond.notify_all()
+
+    def apply(self, kind: str, namespace: str, name: str, patch: Any) -> Dict[str, Any]:
+        with self.cond:
+            key = (kind, namespace or '', name)
+            obj = self.objects.get(key)
+            if obj is None:
+                if isinstance(patch, list):
+                    return None
+                obj = {'apiVersion': 'v1', 'kind': kind, 'metadata': {
+                    'name': name, 'creationTimestamp': _now()}}
+                if namespace:
+                    obj['metadata']['namespace'] = namespace
+                event_type = 'ADDED'
+            else:
+                event_type = 'MODIFIED'
+
+            if isinstance(patch, list):
+                # JSON patch, only removing fields is supported
+                for operation in patch:
+                    parts = operation['path'].strip('/').split('/')
+                    parent = obj
+                    for part in parts[:-1]:
+                        parent = parent[part]
+                    parent.pop(parts[-1], None)
+            else:
+                _merge(obj, patch)
+
+            if kind == 'Pod' and event_type == 'ADDED':
+                obj['status'] = {'phase': 'Pending'}
+
+            self.objects[key] = obj
+            self._record(event_type, obj)
+
+            if kind == 'Pod' and not obj['spec'].get('schedulingGates'):
+                self._schedule(key)
+
+            return copy.deepcopy(obj)
+
+    def _schedule(self, key: Tuple[str, str, str]):
+        """Start the lifecycle of a pod that can be scheduled, callers hold cond"""
+        obj = self.objects[key]
+        if obj.get('scheduled'):
+            return
+        obj['scheduled'] = True
+        threading.Thread(target=self._lifecycle, args=(key,), daemon=True).start()
+
+    def _lifecycle(self, key: Tuple[str, str, str]):
+        time.sleep(self.pod_start)
+        if not self._set_pod_status(key, {
+            'phase': 'Running',
+            'containerStatuses': [{'name': key[2], 'image': 'fake', 'imageID': '', 'ready': True,
+                                   'restartCount': 0, 'state': {'running': {'startedAt': _now()}}}],
+        }):
+            return
+
+        time.sleep(self.run)
+        self._set_pod_status(key, {
+            'phase': 'Succeeded',
+            'containerStatuses': [{'name': key[2], 'image': 'fake', 'imageID': '', 'ready': False, 'restartCount': 0,
+                                   'state': {'terminated': {'exitCode': 0, 'reason': 'Completed'}}}],
+        })
+
+    def _set_pod_status(self, key: Tuple[str, str, str], status: Dict[str, Any]) -> bool:
+        with self.cond:
+            obj = self.objects.get(key)
+            if obj is None:
+                return False
+            obj['status'] = status
+            self._record('MODIFIED', obj)
+            return True
+
+    def delete(self, kind: str, namespace: str, name: str) -> Dict[str, Any]:
+        with self.cond:
+            obj = self.objects.pop((kind, namespace or '', name), None)
+            if obj is None:
+                return None
+            self._record('DELETED', obj)
+
+            if kind == 'Namespace':
+                for key in [key for key in self.objects if key[1] == name]:
+                    self._record('DELETED', self.objects.pop(key))
+            return copy.deepcopy(obj)
+
+    def get(self, kind: str, namespace: str, name: str) -> Dict[str, Any]:
+        with self.cond:
+            obj = self.objects.get((kind, namespace or '', name))
+            return copy.deepcopy(obj) if obj is not None else None
+
+    def list(self, kind: str, namespace: str, label_selector: str) -> Dict[str, Any]:
+        with self.cond:
+            items = [copy.deepcopy(obj) for key, obj in self.objects.items()
+                     if key[0] == kind and (not namespace or key[1] == namespace) and _matches(obj, label_selector)]
+            if kind == 'Node':
+                items = [{'metadata': {'name': 'node-0'}, 'spec': {},
+                          'status': {'allocatable': {'nvidia.com/gpu': str(self.gpus)}}}]
+            return {'apiVersion': 'v1', 'kind': f'{kind}List', 'items': items,
+                    'metadata': {'resourceVersion': str(self.resource_version)}}
+
+    def watch(self, kind: str, namespace: str, label_selector: str, resource_version: int):
+        """Yield events after resource_version until the client goes away"""
+        position = 0
+        while True:
+            with self.cond:
+                while position < len(self.events) and self.events[position][0] <= resource_version:
+                    position += 1
+                if position >= len(self.events):
+                    self.cond.wait(30)
+                    continue
+                events = self.events[position:]
+                position = len(self.events)
+
+            for version, event_type, event_kind, obj in events:
+                resource_version = version
+                if event_kind != kind or not _matches(obj, label_selector):
+                    continue
+                if namespace and obj['metadata'].get('namespace') != namespace:
+                    continue
+                yield {'type': event_type, 'object': obj}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    cluster: FakeCluster = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        for pattern, kind in ROUTES:
+            match = pattern.match(url.path)
+            if match is not None:
+                return kind, match.groupdict(), query
+        return None, {}, query
+
+    def _send(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, name: str):
+        self._send(404, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                         'reason': 'NotFound', 'code': 404, 'message': f'{name} not found'})
+
+    def _read_body(self) -> Any:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length > 0 else None
+
+    def do_GET(self):
+        self.cluster.requests += 1
+        time.sleep(self.cluster.latency)
+        kind, params, query = self._route()
+
+        if kind == 'Version':
+            return self._send(200, {'major': '1', 'minor': '30', 'gitVersion': 'v1.30.0-fake'})
+
+        if kind is None or not kind.endswith('List'):
+            obj = self.cluster.get(kind, params.get('namespace'), params.get('name')) if kind else None
+            return self._send(200, obj) if obj is not None else self._not_found(self.path)
+
+        item_kind = kind[:-len('List')]
+        if query.get('watch') in ['true', '1', 'True']:
+            return self._watch(item_kind, params.get('namespace'), query)
+
+        self._send(200, self.cluster.list(item_kind, params.get('namespace'), query.get('labelSelector')))
+
+    def _watch(self, kind: str, namespace: str, query: Dict[str, str]):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            for event in self.cluster.watch(kind, namespace, query.get('labelSelector'),
+                                            int(query.get('resourceVersion') or 0)):
+                line = json.dumps(event).encode() + b'\n'
+                self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_PATCH(self):
+        self.cluster.requests += 1
+        time.sleep(self.cluster.latency)
+        kind, params, _ = self._route()
+        obj = self.cluster.apply(kind, params.get('namespace'), params['name'], self._read_body())
+        if obj is None:
+            return self._not_found(params['name'])
+        self._send(200, obj)
+
+    def do_DELETE(self):
+        self.cluster.requests += 1
+        time.sleep(self.cluster.latency)
+        kind, params, _ = self._route()
+        self._read_body()
+        obj = self.cluster.delete(kind, params.get('namespace'), params['name'])
+        if obj is None:
+            return self._not_found(params['name'])
+
+        # namespaces answer with a status, everything else with the deleted object
+        if kind == 'Namespace':
+            obj = {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success', 'code': 200}
+        self._send(200, obj)
+
+
+def serve(cluster: FakeCluster) -> ThreadingHTTPServer:
+    """Serve the cluster's API on a free local port in the background"""
+    handler = type('Handler', (_Handler,), {'cluster': cluster})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
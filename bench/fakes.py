@@ -0,0 +1,193 @@
+import threading
+import time
+import docker
+import mysql.connector.errors
+
+from typing import Any, Dict, List
+
+# Seconds every fake waits per call, keyed by service and operation. The
+# harness overrides them from the command line.
+LATENCIES = {
+    'gitlab': 0.05,
+    'keycloak': 0.02,
+    'mysql': 0.01,
+    'docker.build': 2.0,
+    'docker.push': 1.0,
+    'docker.registry': 0.05,
+    'k8s': 0.01,
+    'pod_start': 1.0,
+    'run': 5.0,
+}
+
+
+def _wait(name: str):
+    latency = LATENCIES.get(name, LATENCIES.get(name.split('.')[0], 0.0))
+    if latency > 0:
+        time.sleep(latency)
+
+
+class _Lazy:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class FakeGitlab:
+    """The parts of python-gitlab the services use. Every commit is signed and
+    every user has a Keycloak identity"""
+
+    def __init__(self, metadata: str = 'runfor: 1\n'):
+        self.metadata = metadata
+        self.session = _Lazy(close=lambda: None)
+        self.projects = _Lazy(get=self._get_project)
+        self.users = _Lazy(get=self._get_user)
+
+    def _get_project(self, project_id, lazy=False):
+        _wait('gitlab') if not lazy else None
+
+        def get_commit(sha, lazy=False):
+            def signature():
+                _wait('gitlab')
+                return {'verification_status': 'verified', 'gpg_key_id': 1}
+            return _Lazy(id=sha, signature=signature)
+
+        def repository_tree(ref=None, get_all=False):
+            _wait('gitlab')
+            return [{'name': 'Dockerfile', 'type': 'blob'}, {'name': 'secd.yml', 'type': 'blob'}]
+
+        def raw(file_path=None, ref=None):
+            _wait('gitlab')
+            return self.metadata.encode()
+
+        return _Lazy(id=project_id, commits=_Lazy(get=get_commit),
+                     repository_tree=repository_tree, files=_Lazy(raw=raw))
+
+    def _get_user(self, user_id):
+        _wait('gitlab')
+        return _Lazy(id=user_id, identities=[{'provider': 'openid_connect', 'extern_uid': f'kc-{user_id}'}])
+
+
+class FakeKeycloak:
+    def get_user_groups(self, user_id: str) -> List[Dict[str, Any]]:
+        _wait('keycloak')
+        return [{'name': 'mysql_bench', 'path': '/mysql_bench'}]
+
+
+class _FakeCursor:
+    def execute(self, statement: str):
+        _wait('mysql')
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class _FakeConnection:
+    def __init__(self, pool: 'FakeMysqlPool'):
+        self.pool = pool
+
+    def cursor(self):
+        return _FakeCursor()
+
+    def close(self):
+        self.pool.slots.release()
+
+
+class FakeMysqlPool:
+    """A connection pool with pool_size connections, get_connection raises
+    PoolError while all are borrowed, like MySQLConnectionPool"""
+
+    def __init__(self, pool_size: int = 5):
+        self.slots = threading.Semaphore(pool_size)
+
+    def get_connection(self):
+        if not self.slots.acquire(blocking=False):
+            raise mysql.connector.errors.PoolError('Failed getting connection; pool exhausted')
+        return _FakeConnection(self)
+
+    def _remove_connections(self):
+        pass
+
+
+class _FakeImage:
+    def __init__(self, daemon: 'FakeDocker', name: str):
+        self.daemon = daemon
+        self.tags = [name]
+        self.attrs = {'Size': 100 * 1024 ** 2,
+                      'Metadata': {'LastTagTime': time.strftime('%Y-%m-%dT%H:%M:%S')}}
+
+    def tag(self, repository: str, tag: str):
+        with self.daemon.lock:
+            self.daemon.images_by_name[f'{repository}:{tag}'] = _FakeImage(
+                self.daemon, f'{repository}:{tag}')
+
+
+class FakeDocker:
+    """A Docker daemon whose builds take docker.build seconds over five steps
+    and whose pushes take docker.push seconds. Pushed images are remembered
+    by the fake registry"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images_by_name: Dict[str, _FakeImage] = {}
+        self.registry = set()
+        self.api = _Lazy(build=self._build, push=self._push,
+                         inspect_distribution=self._inspect_distribution)
+        self.images = _Lazy(get=self._get_image, remove=self._remove_image,
+                            prune=lambda filters=None: {}, list=self._list_images)
+
+    def ping(self):
+        return True
+
+    def login(self, username=None, password=None, registry=None):
+        return {}
+
+    def close(self):
+        pass
+
+    def _build(self, path=None, tag=None, cache_from=None, **kwargs):
+        cached = cache_from is not None
+        steps = 5
+        for step in range(1, steps + 1):
+            yield {'stream': f'Step {step}/{steps} : RUN step {step}\n'}
+            if cached and step < steps:
+                yield {'stream': ' ---> Using cache\n'}
+            else:
+                time.sleep(LATENCIES['docker.build'] / steps)
+
+        with self.lock:
+            self.images_by_name[tag] = _FakeImage(self, tag)
+        yield {'stream': f'Successfully tagged {tag}\n'}
+
+    def _push(self, name, stream=True, decode=True):
+        layers = 3
+        for layer in range(layers):
+            yield {'id': f'layer{layer}', 'status': 'Pushing', 'progressDetail': {'current': 1024, 'total': 1024}}
+            time.sleep(LATENCIES['docker.push'] / layers)
+            yield {'id': f'layer{layer}', 'status': 'Pushed', 'progressDetail': {}}
+
+        with self.lock:
+            self.registry.add(name)
+
+    def _inspect_distribution(self, name, auth_config=None):
+        _wait('docker.registry')
+        with self.lock:
+            if name not in self.registry:
+                raise docker.errors.NotFound(f'manifest for {name} not found')
+        return {'Descriptor': {'digest': 'sha256:fake'}}
+
+    def _get_image(self, name: str):
+        with self.lock:
+            if name not in self.images_by_name:
+                raise docker.errors.ImageNotFound(f'No such image: {name}')
+            return self.images_by_name[name]
+
+    def _remove_image(self, name: str, **kwargs):
+        with self.lock:
+            self.images_by_name.pop(name, None)
+
+    def _list_images(self, name: str = None):
+        with self.lock:
+            return [image for image_name, image in self.images_by_name.items()
+                    if name is None or image_name.startswith(f'{name}:')]
@@ -0,0 +1,404 @@
+"""Replay GitLab pushes against the secd server with local stand-ins for every
+external service and report where the time goes.
+
+Run from the repository root:
+
+    python -m bench.run --pushes 100 --rate 10 --latency docker.build=5
+"""
+import argparse
+import copy
+import http.client
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import bench.fakes as fakes
+import bench.fake_k8s as fake_k8s
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'bench-secret'
+
+# Stages in the order a run goes through them
+STAGES = ['signatures', 'preflight', 'queue', 'metadata', 'identity', 'db_user', 'clone', 'image',
+          'build', 'push', 'cache_dir', 'supersede', 'resources', 'admission', 'pod_start']
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pushes', type=int, default=50,
+                        help='number of pushes to replay')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='pushes per second')
+    parser.add_argument('--users', type=int, default=10,
+                        help='distinct GitLab users pushing')
+    parser.add_argument('--projects', type=int, default=0,
+                        help='distinct projects, 0 for one per push so nothing coalesces')
+    parser.add_argument('--same-image', action='store_true',
+                        help='push commits with the same tree so every run after the first reuses its image')
+    parser.add_argument('--latency', action='append', default=[], metavar='NAME=SECONDS',
+                        help=f'latency of a fake, one of {", ".join(fakes.LATENCIES)}')
+    parser.add_argument('--gpus', type=int, default=4,
+                        help='allocatable GPUs of the fake cluster')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='run queue workers')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='server threads')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for all runs to finish')
+    parser.add_argument('--output', help='also write the report as JSON to this file')
+    return parser.parse_args()
+
+
+def _git(cwd: str, *args: str) -> str:
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def _create_remote(root: str, commits: int, same_image: bool) -> (str, List[str]):
+    """A bare repository with one commit per push, returns its path and the commit shas"""
+    remote = f'{root}/remote.git'
+    work = f'{root}/work'
+    _git(root, 'init', '--bare', '-b', 'main', remote)
+    _git(root, 'clone', remote, work)
+    _git(work, 'config', 'user.email', 'bench@localhost')
+    _git(work, 'config', 'user.name', 'bench')
+
+    with open(f'{work}/Dockerfile', 'w') as dockerfile:
+        dockerfile.write('FROM python:3.11-slim\nCOPY . /app\nCMD ["python", "/app/train.py"]\n')
+    with open(f'{work}/secd.yml', 'w') as metadata:
+        metadata.write('runfor: 1\n')
+
+    shas = []
+    for i in range(commits):
+        with open(f'{work}/train.py', 'w') as train:
+            train.write(f'print("run {0 if same_image else i}")\n')
+        _git(work, 'add', '-A')
+        _git(work, 'commit', '--allow-empty', '-q', '-m', f'Run {i}')
+        shas.append(_git(work, 'rev-parse', 'HEAD'))
+
+    _git(work, 'push', '-q', 'origin', 'main')
+    return remote, shas
+
+
+def _write_config(root: str, args: argparse.Namespace) -> str:
+    config = {
+        'path': {
+            'repoPath': f'{root}/repos',
+            'cachePath': f'{root}/cache',
+            'statePath': f'{root}/state',
+            'mirrorPath': f'{root}/mirrors',
+        },
+        'gitlab': {'url': 'http://gitlab.invalid', 'token': 'token', 'secret': SECRET,
+                   'username': 'bench', 'password': 'bench'},
+        'keycloak': {'url': 'http://keycloak.invalid', 'realm': 'bench', 'username': 'bench', 'password': 'bench'},
+        'db': {'host': 'mysql.invalid', 'username': 'bench', 'password': 'bench', 'poolSize': 5},
+        'registry': {'url': 'registry.invalid', 'project': 'bench', 'username': 'bench', 'password': 'bench'},
+        'k8s': {'configPath': f'{root}/kubeconfig', 'pvcPath': '/mnt/secd'},
+        'queue': {'workers': args.workers, 'maxSize': max(args.pushes, 1), 'debounce': 0},
+        'server': {'threads': args.threads},
+    }
+    for path in config['path'].values():
+        os.makedirs(path, exist_ok=True)
+
+    config_path = f'{root}/config.yml'
+    with open(config_path, 'w') as config_file:
+        yaml.dump(config, config_file)
+    return config_path
+
+
+def _start_secd(cluster_url: str, pool_size: int):
+    """Start the server the way server.run does, with the fakes in place of the clients"""
+    import kubernetes
+    import src.client_registry as client_registry
+    import src.server as server
+    import src.run_queue as run_queue
+    import src.launcher as launcher
+    import src.finalizer as finalizer
+    import src.daemon as daemon
+
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    def create_k8s_client():
+        configuration = kubernetes.client.Configuration()
+        configuration.host = cluster_url
+        return kubernetes.client.ApiClient(configuration)
+
+    client_registry.register('k8s', create_k8s_client)
+    client_registry.register('gitlab', fakes.FakeGitlab)
+    client_registry.register('keycloak', fakes.FakeKeycloak)
+    client_registry.register('mysql', lambda: fakes.FakeMysqlPool(pool_size))
+    client_registry.register('docker', fakes.FakeDocker)
+
+    run_queue.start(launcher.create)
+    finalizer.start()
+    threading.Thread(target=daemon.run, daemon=True).start()
+
+    server.PooledWSGIServer.pool = ThreadPoolExecutor(
+        max_workers=server._get_server_settings()['threads'], thread_name_prefix='secd-http')
+    httpd = make_server('127.0.0.1', 0, server.app,
+                        server_class=server.PooledWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd.server_address[1]
+
+
+def _post_push(port: int, body: Dict[str, Any]) -> (float, int, str):
+    data = json.dumps(body)
+    headers = {'Content-Type': 'application/json',
+               'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': SECRET}
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    try:
+        connection.request('POST', '/v1/hook', data, headers)
+        response = connection.getresponse()
+        payload = response.read()
+        status = response.status
+    finally:
+        connection.close()
+
+    run_id = None
+    if status < 300:
+        run_id = json.loads(payload).get('run_id')
+    return time.perf_counter() - started, status, run_id
+
+
+def _replay(port: int, args: argparse.Namespace, remote: str, shas: List[str]) -> List[Dict[str, Any]]:
+    """Send the pushes open loop at the given rate, slow responses do not delay later pushes"""
+    with open(f'{ROOT}/mock/gitlab-push.json') as push_file:
+        template = json.load(push_file)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def send(i: int):
+        body = copy.deepcopy(template)
+        project_id = i % args.projects if args.projects > 0 else i
+        body['project_id'] = body['project']['id'] = 1000 + project_id
+        body['project']['http_url'] = remote
+        body['project']['path_with_namespace'] = f'bench/project-{project_id}'
+        body['user_id'] = 1 + i % args.users
+        body['checkout_sha'] = body['after'] = shas[i]
+        body['commits'] = [dict(body['commits'][0], id=shas[i])]
+
+        try:
+            seconds, status, run_id = _post_push(port, body)
+        except Exception as e:
+            seconds, status, run_id = None, str(e), None
+        with results_lock:
+            results.append({'push': i, 'seconds': seconds,
+                           'status': status, 'run_id': run_id})
+
+    with ThreadPoolExecutor(max_workers=64) as senders:
+        started = time.perf_counter()
+        for i in range(args.pushes):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            senders.submit(send, i)
+
+    return results
+
+
+def _sample(stop: threading.Event, samples: List[Dict[str, float]]):
+    """Record the active runs and the reaper's work every half second"""
+    from prometheus_client import REGISTRY
+
+    while not stop.wait(0.5):
+        samples.append({
+            'time': time.time(),
+            'active_runs': REGISTRY.get_sample_value('secd_active_runs') or 0,
+            'reaper_cycles': REGISTRY.get_sample_value('secd_reaper_cycle_seconds_count') or 0,
+            'reaper_seconds': REGISTRY.get_sample_value('secd_reaper_cycle_seconds_sum') or 0,
+        })
+
+
+def _wait_for_runs(run_ids: List[str], timeout: float) -> List[Dict[str, Any]]:
+    import src.run_registry as run_registry
+
+    deadline = time.time() + timeout
+    while True:
+        runs = [run_registry.get(run_id) for run_id in run_ids]
+        finished = [run for run in runs if run is not None and run['state'] in ['done', 'failed']]
+        if len(finished) == len(run_ids) or time.time() > deadline:
+            return [run for run in runs if run is not None]
+        time.sleep(1)
+
+
+def _quantile(values: List[float], q: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _histogram_quantile(buckets: List[tuple], q: float) -> float:
+    """Upper bound of the bucket holding quantile q, buckets are (le, cumulative count)"""
+    total = buckets[-1][1]
+    for le, count in buckets:
+        if count >= q * total:
+            return le
+    return float('inf')
+
+
+def _stage_report() -> Dict[str, Dict[str, float]]:
+    from prometheus_client import REGISTRY
+
+    stages = {}
+    for metric in REGISTRY.collect():
+        if metric.name != 'secd_stage_seconds':
+            continue
+        for sample in metric.samples:
+            stage = stages.setdefault(sample.labels['stage'], {'buckets': []})
+            if sample.name.endswith('_bucket'):
+                stage['buckets'].append((float(sample.labels['le']), sample.value))
+            elif sample.name.endswith('_sum'):
+                stage['sum'] = sample.value
+            elif sample.name.endswith('_count'):
+                stage['count'] = sample.value
+
+    report = {}
+    for name in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+        stage = stages[name]
+        if not stage.get('count'):
+            continue
+        buckets = sorted(stage['buckets'])
+        report[name] = {
+            'count': stage['count'],
+            'mean': stage['sum'] / stage['count'],
+            'p50': _histogram_quantile(buckets, 0.5),
+            'p99': _histogram_quantile(buckets, 0.99),
+        }
+    return report
+
+
+def _launch_report(runs: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    launched = [run for run in runs if 'running' in run['state_times']]
+    launch_seconds = [run['state_times']['running'] - run['state_times']['queued']
+                      for run in launched if 'queued' in run['state_times']]
+    states = {}
+    for run in runs:
+        states[run['state']] = states.get(run['state'], 0) + 1
+
+    first_queued = min((run['state_times'].get('queued', run['created_at']) for run in runs), default=None)
+    last_running = max((run['state_times']['running'] for run in launched), default=None)
+    span = last_running - first_queued if launched else None
+    return {
+        'runs': len(runs),
+        'launched': len(launched),
+        'states': states,
+        'throughput': len(launched) / span if span else None,
+        'queued_to_running_p50': _quantile(launch_seconds, 0.5),
+        'queued_to_running_p99': _quantile(launch_seconds, 0.99),
+        'elapsed': elapsed,
+    }
+
+
+def _reaper_report(samples: List[Dict[str, float]]) -> List[Dict[str, float]]:
+    """Mean reaper cycle time by the number of active runs when the cycles ran"""
+    levels = {}
+    for previous, sample in zip(samples, samples[1:]):
+        cycles = sample['reaper_cycles'] - previous['reaper_cycles']
+        if cycles <= 0:
+            continue
+        level = int(sample['active_runs'] // 10 * 10)
+        cycles_total, seconds_total = levels.get(level, (0, 0.0))
+        levels[level] = (cycles_total + cycles,
+                         seconds_total + sample['reaper_seconds'] - previous['reaper_seconds'])
+
+    return [{'active_runs': f'{level}-{level + 9}', 'cycles': cycles, 'mean': seconds / cycles}
+            for level, (cycles, seconds) in sorted(levels.items())]
+
+
+def _print_report(report: Dict[str, Any]):
+    def ms(seconds):
+        return '-' if seconds is None else f'{seconds * 1000:.1f}ms'
+
+    webhook = report['webhook']
+    print(f"\nWebhook: {webhook['pushes']} pushes, statuses {webhook['statuses']}")
+    print(f"  p50 {ms(webhook['p50'])}  p99 {ms(webhook['p99'])}  max {ms(webhook['max'])}")
+
+    launch = report['launch']
+    throughput = '-' if launch['throughput'] is None else f"{launch['throughput']:.2f} runs/s"
+    print(f"\nLaunch: {launch['launched']}/{launch['runs']} runs launched, {throughput}, final states {launch['states']}")
+    print(f"  queued to running p50 {ms(launch['queued_to_running_p50'])}  p99 {ms(launch['queued_to_running_p99'])}")
+
+    print('\nStages:')
+    print(f"  {'stage':<12} {'count':>6} {'mean':>10} {'p50 <=':>10} {'p99 <=':>10}")
+    for name, stage in report['stages'].items():
+        print(f"  {name:<12} {stage['count']:>6.0f} {ms(stage['mean']):>10} {ms(stage['p50']):>10} {ms(stage['p99']):>10}")
+
+    print('\nReaper:')
+    print(f"  {'active runs':<12} {'cycles':>6} {'mean':>10}")
+    for level in report['reaper']:
+        print(f"  {level['active_runs']:<12} {level['cycles']:>6.0f} {ms(level['mean']):>10}")
+
+    print(f"\nFake cluster: {report['k8s_requests']} API requests")
+
+
+def main():
+    args = _parse_args()
+    for latency in args.latency:
+        name, _, seconds = latency.partition('=')
+        if name not in fakes.LATENCIES:
+            raise SystemExit(f'Unknown latency {name}, expected one of {", ".join(fakes.LATENCIES)}')
+        fakes.LATENCIES[name] = float(seconds)
+
+    # the settings schema is read relative to the working directory
+    os.chdir(ROOT)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    root = tempfile.mkdtemp(prefix='secd-bench-')
+    os.environ['CONFIG_FILE'] = _write_config(root, args)
+    remote, shas = _create_remote(root, args.pushes, args.same_image)
+
+    cluster = fake_k8s.FakeCluster(latency=fakes.LATENCIES['k8s'], pod_start=fakes.LATENCIES['pod_start'],
+                                   run=fakes.LATENCIES['run'], gpus=args.gpus)
+    cluster_server = fake_k8s.serve(cluster)
+    port = _start_secd(f'http://127.0.0.1:{cluster_server.server_address[1]}', 5)
+
+    samples = []
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample, args=(stop, samples), daemon=True)
+    sampler.start()
+
+    print(f'Replaying {args.pushes} pushes at {args.rate}/s against port {port}, state in {root}')
+    started = time.time()
+    results = _replay(port, args, remote, shas)
+    run_ids = sorted(set(result['run_id'] for result in results if result['run_id'] is not None))
+    runs = _wait_for_runs(run_ids, args.timeout)
+    elapsed = time.time() - started
+    stop.set()
+    sampler.join()
+
+    latencies = [result['seconds'] for result in results if result['seconds'] is not None]
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+
+    report = {
+        'settings': {'pushes': args.pushes, 'rate': args.rate, 'users': args.users,
+                     'projects': args.projects, 'latencies': fakes.LATENCIES},
+        'webhook': {'pushes': len(results), 'statuses': statuses, 'p50': _quantile(latencies, 0.5),
+                    'p99': _quantile(latencies, 0.99), 'max': max(latencies, default=None)},
+        'launch': _launch_report(runs, elapsed),
+        'stages': _stage_report(),
+        'reaper': _reaper_report(samples),
+        'k8s_requests': cluster.requests,
+    }
+    _print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
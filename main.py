@@ -5,6 +5,7 @@ if __name__ == '__main__':
     try:
         log('Loading settings...')
         setup.load_settings()
+        setup.watch_settings()
 
         log("Starting up...")
         server.run()
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+
+class TTLCache:
+    """Thread-safe LRU cache where every entry expires after ttl seconds"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self._stats['misses'] += 1
+                return default
+
+            self._items.move_to_end(key)
+            self._stats['hits'] += 1
+            return item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._items.get(key)
+            return item is not None and item[0] >= time.monotonic()
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key: Hashable) -> Any:
+        """Remove an entry without counting a lookup, returns its value or None"""
+        with self._lock:
+            item = self._items.pop(key, None)
+            return item[1] if item is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, size=len(self._items),
+                        hit_rate=self._stats['hits'] / lookups if lookups else 0.0)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+from typing import Any, Callable, Dict
+from src.logger import log
+
+
+class _Entry:
+    def __init__(self, factory: Callable[[], Any], health_check: Callable[[Any], bool], close: Callable[[Any], None], max_age: float, check_interval: float):
+        self.factory = factory
+        self.health_check = health_check
+        self.close = close
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.client = None
+        self.created_at = 0.0
+        self.checked_at = 0.0
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'reconnects': 0,
+            'health_failures': 0,
+        }
+
+
+_lock = threading.Lock()
+_entries: Dict[str, _Entry] = {}
+
+
+def register(name: str, factory: Callable[[], Any], health_check: Callable[[Any], bool] = None, close: Callable[[Any], None] = None, max_age: float = None, check_interval: float = 60):
+    """Register a lazily created, process-wide client under name"""
+    with _lock:
+        old = _entries.get(name)
+        _entries[name] = _Entry(factory, health_check, close,
+                                max_age, check_interval)
+
+    if old is not None and old.client is not None:
+        _close(name, old)
+
+
+def get(name: str) -> Any:
+    """Get the shared client registered under name, creating or reconnecting it if needed"""
+    entry = _entries.get(name)
+    if entry is None:
+        raise Exception(f'No client registered with name {name}')
+
+    with entry.lock:
+        now = time.monotonic()
+        if entry.client is not None and _is_usable(name, entry, now):
+            entry.stats['reused'] += 1
+            return entry.client
+
+        if entry.client is not None:
+            entry.stats['reconnects'] += 1
+            _close(name, entry)
+            entry.client = None
+
+        entry.client = entry.factory()
+        entry.created_at = now
+        entry.checked_at = now
+        entry.stats['created'] += 1
+        return entry.client
+
+
+def invalidate(name: str = None):
+    """Drop the shared client(s) so the next get() builds a new one"""
+    with _lock:
+        names = [name] if name is not None else list(_entries.keys())
+
+    for client_name in names:
+        entry = _entries.get(client_name)
+        if entry is None:
+            continue
+
+        with entry.lock:
+            if entry.client is not None:
+                _close(client_name, entry)
+                entry.client = None
+
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    with _lock:
+        return {name: dict(entry.stats, connected=entry.client is not None) for name, entry in _entries.items()}
+
+
+def _is_usable(name: str, entry: _Entry, now: float) -> bool:
+    if entry.max_age is not None and now - entry.created_at > entry.max_age:
+        return False
+
+    if entry.health_check is None or now - entry.checked_at < entry.check_interval:
+        return True
+
+    entry.checked_at = now
+    try:
+        healthy = entry.health_check(entry.client)
+    except Exception as e:
+        log(f'Health check for client {name} failed. Details: {e}', "ERROR")
+        healthy = False
+
+    if not healthy:
+        entry.stats['health_failures'] += 1
+
+    return healthy
+
+
+def _close(name: str, entry: _Entry):
+    close = entry.close
+    if close is None:
+        close = getattr(type(entry.client), 'close', None)
+
+    if close is None:
+        return
+
+    try:
+        close(entry.client)
+    except Exception as e:
+        log(f'Error closing client {name}. Details: {e}', "ERROR")
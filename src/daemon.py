@@ -1,16 +1,448 @@
+import datetime
+import heapq
+import threading
 import time
+
+from typing import Any, Callable, Dict, List, Set, Tuple
+from kubernetes.client.rest import ApiException
+
 import src.k8s_service as k8s_service
-import src.gitlab_service as gitlab_service
-from src.logger import log
+import src.finalizer as finalizer
+import src.gpu_scheduler as gpu_scheduler
+import src.mysql_service as mysql_service
+import src.metrics as metrics
+import src.run_registry as run_registry
+import src.tracing as tracing
+from src.setup import get_settings
+from src.logger import log, log_context
+
+# Seconds to wait before retrying a failed watch or a failed reap
+RETRY_DELAY = 5
+
+# Index of active runs, kept up to date by the namespace and pod watches.
+# Deadlines are kept in a min-heap, stale heap entries are skipped when popped
+_cond = threading.Condition()
+_deadlines: List[Tuple[float, str]] = []
+_active_runs: Dict[str, float] = {}
+_completed_runs: Set[str] = set()
+_finishing_runs: Set[str] = set()
+_started_runs: Set[str] = set()
+_gpu_runs: Set[str] = set()
+# runfor hours of runs whose clock starts once their pod runs
+_unstarted_runs: Dict[str, float] = {}
+# (failure class, details, reap at) of runs whose pod failed or is stuck
+_failed_runs: Dict[str, Tuple[str, str, float]] = {}
+# runs whose namespace is being deleted, until it is gone. Their pods are
+# terminated, which is neither a failure nor a new run
+_deleted_runs: Set[str] = set()
+
+# When the daemon started. Pods that started running before were observed
+# by the previous daemon, they are not observed again on the first list
+_daemon_started_at = 0.0
+
+# Waiting reasons of containers whose image can not be pulled
+IMAGE_PULL_ERRORS = ['ImagePullBackOff', 'ErrImagePull', 'InvalidImageName']
+
+metrics.ACTIVE_RUNS.set_function(lambda: len(_active_runs))
+metrics.GPU_RUNS.set_function(lambda: len(_gpu_runs))
+
+
+def _get_grace_settings() -> Dict[str, Any]:
+    """Seconds a failed run keeps its resources, per failure class"""
+    grace_settings = get_settings().get('reaper', {}).get('grace', {})
+    return {
+        'failed': grace_settings.get('failed', 30),
+        'oomKilled': grace_settings.get('oomKilled', 30),
+        'evicted': grace_settings.get('evicted', 30),
+        'imagePull': grace_settings.get('imagePull', 300),
+    }
+
+
+def _get_start_timeout() -> float:
+    """Seconds a run may wait for its pod to run, from namespace creation"""
+    return get_settings().get('reaper', {}).get('startTimeout', 24 * 60 * 60)
+
+
+def _classify_failure(pod) -> Tuple[str, str]:
+    """Failure class and details of a pod that failed or can not start, or (None, None)"""
+    # init containers stage the cache in and sync it back, the run's
+    # container comes first
+    statuses = (pod.status.container_statuses or []) + (pod.status.init_container_statuses or [])
+
+    if pod.status.phase == 'Failed':
+        if pod.status.reason == 'Evicted':
+            return 'evicted', pod.status.message or 'Evicted'
+
+        for status in statuses:
+            terminated = status.state.terminated if status.state is not None else None
+            if terminated is None:
+                continue
+            if terminated.reason == 'OOMKilled':
+                return 'oomKilled', 'OOMKilled'
+            return 'failed', f'{terminated.reason} with exit code {terminated.exit_code}'
+
+        return 'failed', pod.status.reason or pod.status.message or 'Failed'
+
+    for status in statuses:
+        waiting = status.state.waiting if status.state is not None else None
+        if waiting is not None and waiting.reason in IMAGE_PULL_ERRORS:
+            return 'imagePull', f'{waiting.reason}: {waiting.message or status.image}'
+
+    return None, None
+
+
+def _parse_deadline(namespace) -> float:
+    annotations = namespace.metadata.annotations or {}
+    if 'rununtil' not in annotations:
+        return None
+
+    return datetime.datetime.fromisoformat(annotations['rununtil']).timestamp()
+
+
+def _parse_run_for(namespace) -> float:
+    annotations = namespace.metadata.annotations or {}
+    if 'runfor' not in annotations:
+        return None
+
+    return float(annotations['runfor'])
+
+
+def _start_clock(run_id: str, run_for: float):
+    """Start the runfor clock of a run whose pod is running"""
+    log(f"Run {run_id} is running, starting its {run_for} hour clock", run_id=run_id)
+    # replaces the start deadline right away, the namespace watch then
+    # tracks the rununtil annotation
+    _track_run(run_id, time.time() + run_for * 60 * 60)
+    try:
+        k8s_service.start_run_clock(run_id, run_for)
+    except Exception as e:
+        # the namespace watch never sees rununtil, reap from memory instead
+        log(f"Error starting the clock of run {run_id}. Details: {e}", "ERROR", run_id=run_id)
+
+
+def _track_run(run_id: str, deadline: float):
+    with _cond:
+        if run_id in _finishing_runs or _active_runs.get(run_id) == deadline:
+            return
+
+        _active_runs[run_id] = deadline
+        heapq.heappush(_deadlines, (deadline, run_id))
+        _cond.notify()
+
+
+def _forget_run(run_id: str):
+    with _cond:
+        _active_runs.pop(run_id, None)
+        _completed_runs.discard(run_id)
+        _finishing_runs.discard(run_id)
+        _started_runs.discard(run_id)
+        _gpu_runs.discard(run_id)
+        _unstarted_runs.pop(run_id, None)
+        _failed_runs.pop(run_id, None)
+
+
+def _on_namespace(event_type: str, namespace):
+    run_id = k8s_service.get_run_id(namespace.metadata.name)
+
+    if event_type == 'DELETED' or namespace.metadata.deletion_timestamp is not None:
+        _forget_run(run_id)
+        with _cond:
+            if event_type == 'DELETED':
+                _deleted_runs.discard(run_id)
+            else:
+                _deleted_runs.add(run_id)
+        return
+
+    deadline = _parse_deadline(namespace)
+    if deadline is not None:
+        with _cond:
+            _unstarted_runs.pop(run_id, None)
+            changed = _active_runs.get(run_id) != deadline and run_id not in _finishing_runs
+        if changed:
+            _record_deadline(run_id, deadline)
+        _track_run(run_id, deadline)
+        return
+
+    run_for = _parse_run_for(namespace)
+    if run_for is None:
+        return
+
+    with _cond:
+        started = run_id in _started_runs
+        if not started:
+            _unstarted_runs[run_id] = run_for
+            _cond.notify()
+
+    if started:
+        _start_clock(run_id, run_for)
+        return
+
+    # a pod that was deleted, never created or is never admitted would
+    # otherwise keep the run's resources forever
+    created_at = namespace.metadata.creation_timestamp
+    start_deadline = (created_at.timestamp() if created_at is not None else time.time()) + _get_start_timeout()
+    with _cond:
+        tracked = run_id in _active_runs
+    if not tracked:
+        _track_run(run_id, start_deadline)
+
+
+def _record_deadline(run_id: str, deadline: float):
+    try:
+        run_registry.update(run_id, deadline=deadline)
+    except Exception as e:
+        log(f"Error recording the deadline of run {run_id}. Details: {e}", "ERROR")
+
+
+def _reconcile_registry():
+    """Finish runs the registry has as running but whose namespace is gone"""
+    listed_at = time.time()
+    namespaces, _ = k8s_service.list_runs()
+    for run_id in run_registry.reconcile(namespaces, listed_at):
+        log(f"Run {run_id} has no namespace anymore, finishing it", run_id=run_id)
+        finalizer.submit(run_id, 'namespace deleted')
+
+
+def _on_namespaces_listed(namespaces: List):
+    listed = set(k8s_service.get_run_id(
+        namespace.metadata.name) for namespace in namespaces)
+
+    with _cond:
+        for run_id in list(_active_runs.keys()):
+            if run_id not in listed:
+                _forget_run(run_id)
+        _deleted_runs.intersection_update(listed)
+
+    for namespace in namespaces:
+        _on_namespace('ADDED', namespace)
+
+
+def _observe_pod_start(run_id: str, pod):
+    """Record the time from pod creation until its container runs, once per run"""
+    if run_id in _started_runs or not pod.status.container_statuses:
+        return
+
+    state = pod.status.container_statuses[0].state
+    if state is None or state.running is None or state.running.started_at is None:
+        return
+
+    _started_runs.add(run_id)
+    if state.running.started_at.timestamp() < _daemon_started_at:
+        return
+    metrics.STAGE_SECONDS.labels('pod_start').observe(
+        (state.running.started_at - pod.metadata.creation_timestamp).total_seconds())
+
+    created_at = pod.metadata.creation_timestamp.timestamp()
+    started_at = state.running.started_at.timestamp()
+    pod_span_id = tracing.record(run_id, 'pod', created_at, started_at, pod=pod.metadata.name)
+
+    # scheduling includes waiting for GPU admission, starting includes pulling the image
+    scheduled = [condition for condition in pod.status.conditions or []
+                 if condition.type == 'PodScheduled' and condition.status == 'True' and condition.last_transition_time]
+    if scheduled:
+        scheduled_at = scheduled[0].last_transition_time.timestamp()
+        tracing.record(run_id, 'scheduling', created_at, scheduled_at, parent_id=pod_span_id,
+                       node=pod.spec.node_name or '')
+        tracing.record(run_id, 'start', scheduled_at, started_at, parent_id=pod_span_id)
+
+
+def _on_pod(event_type: str, pod):
+    run_id = k8s_service.get_run_id(pod.metadata.namespace)
+
+    with _cond:
+        phase = pod.status.phase if pod.status is not None else None
+        labels = pod.metadata.labels or {}
+        if event_type != 'DELETED' and labels.get('gpu') == 'true' and phase in ['Pending', 'Running']:
+            _gpu_runs.add(run_id)
+        else:
+            _gpu_runs.discard(run_id)
+
+    # GPU pods waiting for admission or freeing their GPU
+    gpu_scheduler.update_pod(event_type, pod)
+
+    if event_type == 'DELETED' or pod.status is None or pod.metadata.deletion_timestamp is not None:
+        return
+
+    # the pod of a run that is reaped or deleted is terminated
+    with _cond:
+        if run_id in _finishing_runs or run_id in _deleted_runs:
+            return
+
+    with _cond:
+        _observe_pod_start(run_id, pod)
+        run_for = _unstarted_runs.pop(
+            run_id, None) if run_id in _started_runs else None
+
+    if run_for is not None:
+        _start_clock(run_id, run_for)
+
+    _track_failure(run_id, pod)
+
+    if pod.status.phase != 'Succeeded':
+        return
+
+    with _cond:
+        detected = run_id not in _completed_runs
+        _completed_runs.add(run_id)
+        _cond.notify()
+
+    if detected:
+        now = time.time()
+        tracing.record(run_id, 'detected', now, now, reason='completed')
+
+
+def _track_failure(run_id: str, pod):
+    """Reap a run with a failed or stuck pod after the grace period of its failure class"""
+    failure, details = _classify_failure(pod)
+
+    with _cond:
+        if failure is None:
+            # the image could be pulled after all
+            if _failed_runs.pop(run_id, None) is not None:
+                log(f"Run {run_id} recovered", run_id=run_id)
+            return
+
+        if run_id in _failed_runs:
+            return
+
+        grace = _get_grace_settings()[failure]
+        now = time.time()
+        _failed_runs[run_id] = (failure, details, now + grace)
+        _cond.notify()
+
+    tracing.record(run_id, 'detected', now, now, reason=failure, details=details, grace=grace)
+
+    log(f"Run {run_id} {failure} - {details}, reclaiming in {grace}s", "WARNING", run_id=run_id)
+
+
+def _on_pods_listed(pods: List):
+    gpu_scheduler.set_pods(pods)
+    for pod in pods:
+        _on_pod('ADDED', pod)
+
+
+def _watch(kind: str, list_items: Callable, watch_items: Callable, on_listed: Callable, on_event: Callable):
+    """List once, then follow changes. Relists only when the watch can not be resumed"""
+    while True:
+        try:
+            items, resource_version = list_items()
+            on_listed(items)
+
+            for event in watch_items(resource_version):
+                on_event(event['type'], event['object'])
+        except ApiException as e:
+            if e.status == 410:
+                log(f"Watch on {kind} expired, relisting")
+                continue
+
+            log(f"Error watching {kind}. Details: {e}", "ERROR")
+            time.sleep(RETRY_DELAY)
+        except Exception as e:
+            log(f"Error watching {kind}. Details: {e}", "ERROR")
+            time.sleep(RETRY_DELAY)
+
+
+def _next_due() -> List[Tuple[str, str]]:
+    """Block until at least one run is due, then return (run_id, reason) for every due run"""
+    with _cond:
+        while True:
+            due = []
+            for run_id in list(_completed_runs):
+                # a run can complete before its clock was started
+                if run_id in _active_runs or run_id in _unstarted_runs:
+                    _completed_runs.discard(run_id)
+                    _active_runs.pop(run_id, None)
+                    _unstarted_runs.pop(run_id, None)
+                    _finishing_runs.add(run_id)
+                    due.append((run_id, 'completed'))
+
+            now = time.time()
+            for run_id, (failure, details, reap_at) in list(_failed_runs.items()):
+                if reap_at > now or run_id in _finishing_runs:
+                    continue
+                # until the namespace is seen there is nothing to reap
+                if run_id in _active_runs or run_id in _unstarted_runs:
+                    _failed_runs.pop(run_id)
+                    _active_runs.pop(run_id, None)
+                    _unstarted_runs.pop(run_id, None)
+                    _finishing_runs.add(run_id)
+                    metrics.RECLAIMED_RUNS.labels(failure).inc()
+                    due.append((run_id, f'{failure} - {details}'))
+
+            while _deadlines and _deadlines[0][0] <= now:
+                deadline, run_id = heapq.heappop(_deadlines)
+                if _active_runs.get(run_id) != deadline:
+                    continue
+
+                _active_runs.pop(run_id)
+                _finishing_runs.add(run_id)
+                if _unstarted_runs.pop(run_id, None) is not None:
+                    due.append((run_id, 'not started within the start timeout'))
+                else:
+                    due.append((run_id, 'expired rununtil'))
+
+            if due:
+                return due
+
+            wake_at = [reap_at for _, _, reap_at in _failed_runs.values()
+                       if reap_at > now]
+            if _deadlines:
+                wake_at.append(_deadlines[0][0])
+            _cond.wait(min(wake_at) - now if wake_at else None)
+
+
+def _finish_run(run_id: str, reason: str) -> bool:
+    with log_context(run_id=run_id, stage='reap'), tracing.span('reap', run_id=run_id, reason=reason):
+        return _finish_run_resources(run_id, reason)
+
+
+def _finish_run_resources(run_id: str, reason: str) -> bool:
+    log(f"Finishing run secd-{run_id} - {reason} - Delete resources")
+    try:
+        k8s_service.delete_run(run_id)
+    except Exception as e:
+        log(f"Error deleting resources of run {run_id}, retrying. Details: {e}", "ERROR")
+        with _cond:
+            _finishing_runs.discard(run_id)
+        _track_run(run_id, time.time() + RETRY_DELAY)
+        return False
+
+    # results are pushed by the finalizer so slow pushes never hold up reaping
+    finalizer.submit(run_id, reason)
+    return True
+
+
+def _drop_db_users(run_ids: List[str]):
+    try:
+        mysql_service.delete_mysql_users(run_ids)
+    except Exception as e:
+        log(f"Error dropping database users of runs {', '.join(run_ids)}. Details: {e}", "ERROR")
 
 
 def run():
+    global _daemon_started_at
     log("Starting daemon...")
-    while True:
-        cleaned_run_ids = k8s_service.cleanup_resources()
-        for run_id in cleaned_run_ids:
-            log(f"Finishing run {run_id} - expired rununtil - Pushing results")
-            gitlab_service.push_results(run_id)
-            log(f"Finishing run {run_id} - Finished and cleaned up")
+    _daemon_started_at = time.time()
+
+    try:
+        k8s_service.label_legacy_runs()
+    except Exception as e:
+        log(f"Error labeling legacy runs. Details: {e}", "ERROR")
 
-        time.sleep(5)
+    try:
+        _reconcile_registry()
+    except Exception as e:
+        log(f"Error reconciling the run registry. Details: {e}", "ERROR")
+
+    threading.Thread(target=_watch, daemon=True, args=(
+        'namespaces', k8s_service.list_runs, k8s_service.watch_runs, _on_namespaces_listed, _on_namespace)).start()
+    threading.Thread(target=_watch, daemon=True, args=(
+        'pods', k8s_service.list_run_pods, k8s_service.watch_run_pods, _on_pods_listed, _on_pod)).start()
+    threading.Thread(target=gpu_scheduler.run, daemon=True).start()
+
+    while True:
+        due = _next_due()
+        with metrics.REAPER_CYCLE_SECONDS.time():
+            finished = [run_id for run_id, reason in due
+                        if _finish_run(run_id, reason)]
+            _drop_db_users(finished)
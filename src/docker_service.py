@@ -1,25 +1,212 @@
+import datetime
+import threading
+import time
 import docker
+
+import src.client_registry as client_registry
+import src.metrics as metrics
+
+from typing import Dict, List
+from src.cache import TTLCache
 from src.setup import get_settings
 from src.logger import log
 
 
-def _with_docker():
-    client = docker.from_env()
-    return client
+client_registry.register('docker', docker.from_env,
+                         health_check=lambda client: client.ping())
+
+
+def _with_docker() -> docker.DockerClient:
+    return client_registry.get('docker')
+
+
+# Every project keeps its last build under this local tag, so the layers of
+# the next build of the same project are served from the build cache
+CACHE_REPOSITORY = 'secd-cache'
+
+
+def _get_cache_settings() -> Dict[str, any]:
+    docker_settings = get_settings().get('docker', {})
+    return {
+        'cacheMaxAge': docker_settings.get('cacheMaxAge', 7 * 24) * 60 * 60,
+        'cacheMaxSize': docker_settings.get('cacheMaxSize', 100) * 1024 ** 3,
+    }
+
+
+def get_cache_image(project_id: int) -> str:
+    return f"{CACHE_REPOSITORY}:{project_id}"
+
+
+# Runs of a project with the same source tree share an image tag. The run
+# holding the lock of a tag builds and pushes it, the others wait and then
+# find it in the registry. Keyed by image name, with the number of runs
+# holding or waiting for the lock.
+_image_locks_lock = threading.Lock()
+_image_locks: Dict[str, List] = {}
+
+
+def lock_image(image_name: str):
+    """Wait until no other run builds or pushes image_name"""
+    with _image_locks_lock:
+        entry = _image_locks.setdefault(image_name, [threading.Lock(), 0])
+        entry[1] += 1
+    entry[0].acquire()
 
 
-def build_image(repo_path, image_name):
+def unlock_image(image_name: str):
+    """Let the next run waiting for image_name build or push it, lock_image and unlock_image may run on
+    different threads"""
+    with _image_locks_lock:
+        entry = _image_locks[image_name]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _image_locks[image_name]
+    entry[0].release()
+
+
+def _is_image_awaited(image_name: str) -> bool:
+    """Whether other runs wait for the lock of image_name"""
+    with _image_locks_lock:
+        entry = _image_locks.get(image_name)
+        return entry is not None and entry[1] > 1
+
+
+# Build and push reports of recent runs, keyed by run id
+_reports = TTLCache(ttl=7 * 24 * 60 * 60, max_size=1000)
+
+
+def _get_report(run_id: str, image_name: str) -> Dict[str, any]:
+    report = _reports.get(run_id)
+    if report is None:
+        report = {'run_id': run_id, 'image': image_name}
+        _reports.set(run_id, report)
+    return report
+
+
+def get_report(run_id: str) -> Dict[str, any]:
+    """Get the build and push timings recorded for a run, or None"""
+    return _reports.get(run_id)
+
+
+@metrics.timed_call('docker')
+def build_image(repo_path, image_name, cache_image=None, run_id=None) -> List[Dict[str, any]]:
+    """Build an image, returns every build step with its duration and whether it was served from the cache"""
     log(f"Building image {image_name} at {repo_path}")
     client = _with_docker()
+    report = _get_report(run_id or image_name, image_name)
+
+    cache_from = None
+    if cache_image is not None and _has_image(cache_image):
+        cache_from = [cache_image]
+
+    steps = []
     try:
-        client.images.build(path=repo_path, tag=image_name)
+        # the context is packed and uploaded before the build call returns
+        start = time.monotonic()
+        stream = client.api.build(path=repo_path, tag=image_name, cache_from=cache_from,
+                                  rm=True, forcerm=True, decode=True)
+        report['context_upload_seconds'] = time.monotonic() - start
+        log(f"Run {run_id} - uploaded build context in {report['context_upload_seconds']:.1f}s")
+
+        step_start = time.monotonic()
+        for chunk in stream:
+            if 'error' in chunk:
+                raise Exception(chunk['error'].strip())
+
+            line = chunk.get('stream', '').strip()
+            if line.startswith('Step '):
+                now = time.monotonic()
+                if len(steps) > 0:
+                    steps[-1]['seconds'] = now - step_start
+                step_start = now
+                steps.append({'step': line, 'cached': False, 'seconds': 0.0})
+            elif line == '---> Using cache' and len(steps) > 0:
+                steps[-1]['cached'] = True
+
+        if len(steps) > 0:
+            steps[-1]['seconds'] = time.monotonic() - step_start
     except Exception as e:
         raise Exception(f"Error building image {image_name}: {e}")
+    finally:
+        report['build_seconds'] = time.monotonic() - start
+        report['steps'] = steps
+
+    hits = len([step for step in steps if step['cached']])
+    log(f"Run {run_id} - built image {image_name} in {report['build_seconds']:.1f}s - {hits}/{len(steps)} steps from cache")
+    for step in steps:
+        log(f"Run {run_id} - {'hit ' if step['cached'] else 'miss'} {step['seconds']:.1f}s {step['step']}")
+
+    return steps
+
+
+@metrics.timed_call('docker')
+def image_exists(image_name: str, run_id: str = None) -> bool:
+    """Check if the registry already has image_name, so it does not need to be built"""
+    reg_settings = get_settings()["registry"]
+    auth_config = {
+        'username': reg_settings.get('username'),
+        'password': reg_settings.get('password'),
+    }
+
+    try:
+        _with_docker().api.inspect_distribution(
+            image_name, auth_config=auth_config)
+    except docker.errors.NotFound:
+        exists = False
+    except docker.errors.APIError as e:
+        # registries answer unknown manifests with 401 or 404 depending on the registry
+        if e.status_code not in [401, 403, 404]:
+            raise
+        exists = False
+    else:
+        exists = True
+
+    metrics.IMAGE_CACHE.labels('hit' if exists else 'miss').inc()
+    _get_report(run_id or image_name, image_name)['reused'] = exists
+    return exists
+
+
+def _has_image(image_name: str) -> bool:
+    try:
+        _with_docker().images.get(image_name)
+    except docker.errors.ImageNotFound:
+        return False
+    return True
+
+
+def _track_layer(layers: Dict[str, Dict[str, any]], chunk: Dict[str, any]):
+    """Update the per-layer push progress with one message of the push stream"""
+    layer_id = chunk.get('id')
+    status = chunk.get('status', '')
+    if layer_id is None or 'progressDetail' not in chunk:
+        return
+
+    now = time.monotonic()
+    layer = layers.setdefault(layer_id, {
+        'id': layer_id,
+        'status': status,
+        'bytes': 0,
+        'seconds': 0.0,
+        'throughput': 0.0,
+        'started': None,
+    })
+    layer['status'] = status
 
+    if status == 'Pushing':
+        if layer['started'] is None:
+            layer['started'] = now
+        progress = chunk['progressDetail']
+        layer['bytes'] = max(layer['bytes'], progress.get(
+            'total') or progress.get('current') or 0)
+    elif status == 'Pushed' and layer['started'] is not None:
+        layer['seconds'] = now - layer['started']
+        if layer['seconds'] > 0:
+            layer['throughput'] = layer['bytes'] / layer['seconds']
 
-def push_and_remove_image(image_name):
+
+@metrics.timed_call('docker')
+def push_and_remove_image(image_name, cache_image=None, run_id=None):
     log(f"Pushing image {image_name}")
-    client = _with_docker()
     regSettings = get_settings()["registry"]
 
     url = regSettings.get("url")
@@ -33,22 +220,82 @@ def push_and_remove_image(image_name):
         raise Exception(
             f"Error in login to registry {image_name}: {e}")
 
+    report = _get_report(run_id or image_name, image_name)
+    layers = {}
     try:
-        client.images.push(image_name)
+        start = time.monotonic()
+        for chunk in client.api.push(image_name, stream=True, decode=True):
+            if 'error' in chunk:
+                raise Exception(chunk['error'].strip())
+
+            _track_layer(layers, chunk)
     except Exception as e:
         raise Exception(f"Error pushing image {image_name}: {e}")
+    finally:
+        report['push_seconds'] = time.monotonic() - start
+        report['layers'] = [{key: value for key, value in layer.items() if key != 'started'}
+                            for layer in layers.values()]
 
-    try:
-        client.images.remove(image_name)
-    except:
-        pass
+    pushed = [layer for layer in report['layers'] if layer['status'] == 'Pushed']
+    pushed_bytes = sum(layer['bytes'] for layer in pushed)
+    log(f"Run {run_id} - pushed image {image_name} in {report['push_seconds']:.1f}s - {len(pushed)}/{len(report['layers'])} layers, {pushed_bytes} bytes")
+    for layer in pushed:
+        log(f"Run {run_id} - layer {layer['id']} {layer['bytes']} bytes in {layer['seconds']:.1f}s ({layer['throughput'] / 1024 ** 2:.1f} MiB/s)")
+
+    # keep the layers around for the next build of the project
+    if cache_image is not None:
+        try:
+            repository, tag = cache_image.split(':')
+            client.images.get(image_name).tag(repository, tag)
+        except Exception as e:
+            log(f"Error tagging cache image {cache_image}. Details: {e}", "ERROR")
+
+    # runs waiting for the tag check the registry first, the local tag is
+    # kept for them all the same
+    if not _is_image_awaited(image_name):
+        try:
+            client.images.remove(image_name)
+        except:
+            pass
+
+    evict_cache()
 
-    remove_dangling()
+
+def _get_last_tag_time(image: docker.models.images.Image) -> float:
+    last_tag_time = image.attrs.get('Metadata', {}).get('LastTagTime', '')
+    try:
+        return datetime.datetime.strptime(last_tag_time[:19], '%Y-%m-%dT%H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return 0.0
 
 
-def remove_dangling():
+@metrics.timed_call('docker')
+def evict_cache():
+    """Remove dangling images, then cache images that are too old or beyond the cache size"""
     client = _with_docker()
+    cache_settings = _get_cache_settings()
+
+    try:
+        client.images.prune(filters={'dangling': True})
+    except Exception as e:
+        log(f"Error removing dangling images. Details: {e}", "ERROR")
+
+    now = time.time()
+    cache_images = sorted(client.images.list(name=CACHE_REPOSITORY),
+                          key=_get_last_tag_time, reverse=True)
+
+    total = 0
+    for image in cache_images:
+        total += image.attrs.get('Size', 0)
+        expired = now - _get_last_tag_time(image) > cache_settings['cacheMaxAge']
+        if not expired and total <= cache_settings['cacheMaxSize']:
+            continue
 
-    for image in client.images.list():
-        if image.tags == None:
-            client.images.remove(image.id)
+        log(f"Evicting cache image {', '.join(image.tags)}")
+        total -= image.attrs.get('Size', 0)
+        for tag in image.tags:
+            try:
+                client.images.remove(tag)
+            except Exception as e:
+                log(f"Error evicting cache image {tag}. Details: {e}", "ERROR")
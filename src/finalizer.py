@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+
+import src.gitlab_service as gitlab_service
+import src.metrics as metrics
+import src.run_registry as run_registry
+import src.state_db as state_db
+import src.tracing as tracing
+
+from typing import Any, Dict, List
+from src.setup import get_settings
+from src.logger import log, log_context
+
+# Finished finalizations are kept this long for visibility
+RETENTION = 7 * 24 * 60 * 60
+
+_queue: state_db.WorkQueue = None
+
+
+def _count(state: str) -> int:
+    if _queue is None:
+        return 0
+
+    with _queue.cond:
+        (count,) = _queue.db.execute(
+            'select count(*) from finalizations where state = ?', (state,)).fetchone()
+    return count
+
+
+metrics.PENDING_FINALIZATIONS.set_function(lambda: _count('pending'))
+metrics.FAILED_FINALIZATIONS.set_function(lambda: _count('failed'))
+
+
+def _get_finalizer_settings() -> Dict[str, Any]:
+    finalizer_settings = get_settings().get('finalizer', {})
+    return {
+        'workers': finalizer_settings.get('workers', 4),
+        'retries': finalizer_settings.get('retries', 5),
+        'retryDelay': finalizer_settings.get('retryDelay', 30),
+    }
+
+
+def _open(path: str) -> sqlite3.Connection:
+    db = state_db.connect(path)
+    db.execute('''create table if not exists finalizations (
+        run_id text primary key,
+        reason text,
+        state text not null,
+        attempts integer not null default 0,
+        next_attempt_at real not null,
+        created_at real not null,
+        finished_at real,
+        error text
+    )''')
+    db.execute(
+        'create index if not exists finalizations_state on finalizations (state, next_attempt_at)')
+    return db
+
+
+def start():
+    """Open the finalization store, resume interrupted finalizations and start the workers"""
+    global _queue
+    finalizer_settings = _get_finalizer_settings()
+
+    _queue = state_db.WorkQueue(_open(state_db.get_state_path('secd-finalizer.db')), 'finalizations',
+                                queued_state='pending', due_column='next_attempt_at')
+    _queue.requeue_running()
+    # failed finalizations are kept until they are retried
+    _queue.delete_finished(['done'], RETENTION)
+
+    for i in range(finalizer_settings['workers']):
+        threading.Thread(target=_work, name=f'secd-finalizer-{i}',
+                         daemon=True).start()
+
+
+def submit(run_id: str, reason: str):
+    """Queue pushing the results of a finished run"""
+    now = time.time()
+    with _queue.cond:
+        _queue.db.execute('''insert into finalizations (run_id, reason, state, next_attempt_at, created_at)
+            values (?, ?, 'pending', ?, ?) on conflict (run_id) do nothing''',
+                          (run_id, reason, now, now))
+        _queue.cond.notify()
+
+    try:
+        run_registry.set_state(run_id, 'finalizing', reason=reason)
+    except Exception as e:
+        log(f"Error recording finalization of run {run_id}. Details: {e}", "ERROR")
+
+
+def retry(run_id: str) -> bool:
+    """Retry a failed finalization, returns False if there is no failed finalization for run_id"""
+    with _queue.cond:
+        updated = _queue.db.execute("update finalizations set state = 'pending', attempts = 0, next_attempt_at = ?, error = null where run_id = ? and state = 'failed'",
+                                    (time.time(), run_id)).rowcount
+        _queue.cond.notify()
+
+    return updated > 0
+
+
+def get_status() -> Dict[str, Any]:
+    with _queue.cond:
+        counts = dict(_queue.db.execute(
+            'select state, count(*) from finalizations group by state').fetchall())
+        rows = _queue.db.execute('''select run_id, reason, state, attempts, next_attempt_at, error from finalizations
+            where state != 'done' order by created_at''').fetchall()
+
+    runs: List[Dict[str, Any]] = [{
+        'run_id': run_id,
+        'reason': reason,
+        'state': state,
+        'attempts': attempts,
+        'next_attempt_at': next_attempt_at,
+        'error': error,
+    } for run_id, reason, state, attempts, next_attempt_at, error in rows]
+
+    return {
+        'pending': counts.get('pending', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'runs': runs,
+    }
+
+
+def _finish(run_id: str, attempts: int, error: str = None):
+    finalizer_settings = _get_finalizer_settings()
+
+    if error is not None and attempts <= finalizer_settings['retries']:
+        # back off linearly between attempts
+        _queue.defer(run_id, time.time() + finalizer_settings['retryDelay'] * attempts,
+                     attempts=attempts, error=error)
+    else:
+        _queue.finish(run_id, error, attempts=attempts)
+
+
+def _work():
+    while True:
+        run_id, reason, attempts, _ = _queue.claim(['run_id', 'reason', 'attempts'])
+        with log_context(run_id=run_id, stage='finalize'):
+            log(f"Finishing run {run_id} - {reason} - Pushing results")
+            try:
+                with tracing.span('push_results', run_id=run_id, reason=reason, attempt=attempts + 1):
+                    gitlab_service.push_results(run_id, reason)
+            except Exception as e:
+                log(f"Error pushing results of run {run_id} (attempt {attempts + 1}). Details: {e}", "ERROR")
+                _finish(run_id, attempts + 1, str(e))
+            else:
+                log(f"Finishing run {run_id} - Finished and cleaned up")
+                _finish(run_id, attempts + 1)
+                try:
+                    run_registry.set_state(run_id, 'done')
+                except Exception as e:
+                    log(f"Error recording run {run_id} as done. Details: {e}", "ERROR")
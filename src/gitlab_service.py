@@ -1,18 +1,28 @@
+import contextvars
 import os
 import gitlab
+import hashlib
 import yaml
 import datetime
 import shutil
 import subprocess
+import threading
+import git
 
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 from git import Repo
 from cerberus import Validator
+import src.client_registry as client_registry
+import src.metrics as metrics
+
+from src.cache import TTLCache
+
 from src.setup import get_settings
 from src.logger import log
 
 
-def _with_gitlab_client() -> gitlab.Gitlab:
+def _create_gitlab_client() -> gitlab.Gitlab:
     glSettings = get_settings()['gitlab']
     client = gitlab.Gitlab(
         glSettings['url'], private_token=glSettings['token'])
@@ -20,56 +30,61 @@ def _with_gitlab_client() -> gitlab.Gitlab:
     return client
 
 
-def has_file_in_repo(project_id: str, file_path: str, ref: str) -> bool:
-    client = _with_gitlab_client()
+client_registry.register('gitlab', _create_gitlab_client,
+                         close=lambda client: client.session.close())
 
-    try:
-        project = client.projects.get(project_id)
-    except gitlab.exceptions.GitlabGetError as e:
-        log(f'Project {project_id} not found. Details: {e}', "ERROR")
-        return None
 
-    try:
-        project.files.get(file_path, ref=ref)
-    except gitlab.exceptions.GitlabGetError as e:
-        log(f'File {file_path} not found. Details: {e}', "ERROR")
-        return False
+def _with_gitlab_client() -> gitlab.Gitlab:
+    return client_registry.get('gitlab')
 
-    return True
 
+# A verified signature stays verified, so verified results are cached per
+# (project, commit SHA). Other results are not cached, a key can still be
+# added or verified. Signatures of a push are fetched concurrently with a
+# bounded pool
+_signature_cache = TTLCache(ttl=24 * 60 * 60, max_size=10000)
+_signature_pool = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix='secd-signature')
 
-def get_metadata(file_path: str) -> Dict[str, any]:
+
+METADATA_FILE = 'secd.yml'
+
+METADATA_SCHEMA = {
+    'runfor': {'type': 'number', 'min': 0},
+    'gpu': {'type': 'boolean'},
+    'cache_dir': {'type': 'string', 'nullable': True, 'regex': r'^(?!.*\.\.).*$'},
+    'mount_path': {'type': 'string', 'nullable': True, 'regex': r'^/.*$'},
+}
+
+# A commit's tree never changes, so pre-flight results are cached per (project, sha)
+_preflight_cache = TTLCache(ttl=24 * 60 * 60, max_size=1000)
+
+
+def parse_metadata(content: str) -> Dict[str, any]:
+    """Parse and validate a secd.yml, returns the metadata with defaults or raises on invalid content"""
     default = {
         'runfor': 3,
         'gpu': False
     }
 
-    if not os.path.isfile(file_path):
-        log(f'No metadata file found at {file_path}. Fallback to default')
+    if content is None:
         return default
 
-    with open(file_path, 'r') as f:
-        metadata = f.read()
-        try:
-            yaml_metadata = yaml.safe_load(metadata)
-        except:
-            log(f'Invalid metadata file {file_path}', "ERROR")
-            return None
+    try:
+        yaml_metadata = yaml.safe_load(content)
+    except yaml.YAMLError as e:
+        raise Exception(f'Invalid {METADATA_FILE}: {e}')
 
     if not yaml_metadata:
-        log(f'Invalid metadata file {file_path}. Fallback to default')
         return default
 
-    validation = {
-        'runfor': {'type': 'number'},
-        'gpu': {'type': 'boolean'},
-    }
+    if not isinstance(yaml_metadata, dict):
+        raise Exception(f'Invalid {METADATA_FILE}: expected a mapping')
 
-    v = Validator(validation)
+    v = Validator(METADATA_SCHEMA)
     v.allow_unknown = True
     if not v.validate(yaml_metadata):
-        log(f'Invalid metadata file {file_path}. Fallback to default')
-        return default
+        raise Exception(f'Invalid {METADATA_FILE}: {v.errors}')
 
     for key in default:
         if key not in yaml_metadata:
@@ -78,37 +93,93 @@ def get_metadata(file_path: str) -> Dict[str, any]:
     return yaml_metadata
 
 
-def get_signature(project_id: str, commit_id: str) -> Dict[str, any]:
+def get_preflight(project_id: int, sha: str) -> Dict[str, any]:
+    """Fetch the top-level files and the metadata of a commit without cloning it.
+
+    Returns a dict with 'files', 'metadata' and 'error', where error explains
+    why the commit can not be run, or None"""
+    key = (project_id, sha)
+    cached = _preflight_cache.get(key)
+    if cached is not None:
+        return cached
+
     client = _with_gitlab_client()
+    project = client.projects.get(project_id, lazy=True)
 
+    preflight = {'files': [], 'metadata': None, 'error': None}
     try:
-        project = client.projects.get(project_id)
+        with metrics.client_call('gitlab', 'repository_tree'):
+            tree = project.repository_tree(ref=sha, get_all=True)
     except gitlab.exceptions.GitlabGetError as e:
-        log(f'Project {project_id} not found. Details: {e}', "ERROR")
-        return None
+        log(f'Commit {sha} not found in project {project_id}. Details: {e}', "ERROR")
+        preflight['error'] = f'Commit {sha} not found in project {project_id}'
+        return preflight
+
+    preflight['files'] = [entry['name']
+                          for entry in tree if entry['type'] == 'blob']
+
+    content = None
+    if METADATA_FILE in preflight['files']:
+        with metrics.client_call('gitlab', 'files_raw'):
+            content = project.files.raw(file_path=METADATA_FILE, ref=sha)
 
     try:
-        commit = project.commits.get(commit_id)
-    except gitlab.exceptions.GitlabGetError as e:
-        log(f'Commit {commit_id} not found. Details: {e}', "ERROR")
-        return None
+        preflight['metadata'] = parse_metadata(content)
+    except Exception as e:
+        preflight['error'] = str(e)
+
+    _preflight_cache.set(key, preflight)
+    return preflight
+
+
+def get_signature(project_id: str, commit_id: str) -> Dict[str, any]:
+    key = (project_id, commit_id)
+    cached = _signature_cache.get(key)
+    if cached is not None:
+        return cached
+
+    client = _with_gitlab_client()
+
+    # lazy objects skip the projects.get and commits.get round-trips
+    project = client.projects.get(project_id, lazy=True)
+    commit = project.commits.get(commit_id, lazy=True)
 
     try:
-        gpg_signature = commit.signature()
+        with metrics.client_call('gitlab', 'get_signature'):
+            gpg_signature = commit.signature()
     except gitlab.exceptions.GitlabGetError as e:
         log(
             f'No signature found for {commit_id} (project {project_id}). Details: {e}', "ERROR")
-        gpg_signature = None
+        return None
 
+    if gpg_signature.get('verification_status') == 'verified':
+        _signature_cache.set(key, gpg_signature)
     return gpg_signature
 
 
+def get_signatures(project_id: str, commit_ids: List[str]) -> Dict[str, Dict[str, any]]:
+    """Get the signatures of several commits concurrently, keyed by commit id"""
+    # every lookup runs in a copy of the caller's context, for its log fields and trace
+    contexts = [contextvars.copy_context() for _ in commit_ids]
+    signatures = _signature_pool.map(
+        lambda context, commit_id: context.run(get_signature, project_id, commit_id), contexts, commit_ids)
+
+    return dict(zip(commit_ids, signatures))
+
+
+@metrics.timed_call('gitlab')
 def get_idp_user_id(gitlab_user_id: int) -> str:
+    """The Keycloak user id of a GitLab user, or None if the user or its identity does not exist.
+
+    Raises if GitLab can not be asked"""
     client = _with_gitlab_client()
 
     try:
         user = client.users.get(gitlab_user_id)
     except gitlab.exceptions.GitlabGetError as e:
+        # other errors, such as a GitLab outage, say nothing about the user
+        if e.response_code != 404:
+            raise
         log(f'User {gitlab_user_id} not found. Details: {e}')
         return None
 
@@ -123,16 +194,183 @@ def get_idp_user_id(gitlab_user_id: int) -> str:
     return user.identities[0]['extern_uid']
 
 
-def clone(gitlab_url: str, repo_path: str):
+def _get_mirror_settings() -> Dict[str, any]:
+    path_settings = get_settings()['path']
+    return {
+        'mirrorPath': path_settings.get('mirrorPath', f"{path_settings['repoPath']}/.mirrors"),
+        'mirrorQuota': path_settings.get('mirrorQuota', 50) * 1024 ** 3,
+    }
+
+
+_mirror_locks_lock = threading.Lock()
+_mirror_locks: Dict[str, threading.Lock] = {}
+
+# Bytes used by every mirror, measured once on first use and then only for
+# the mirror that was fetched, so clones do not walk the whole mirror store
+_mirror_sizes_lock = threading.Lock()
+_mirror_sizes: Dict[str, int] = None
+
+
+def _get_mirror_lock(mirror_path: str) -> threading.Lock:
+    with _mirror_locks_lock:
+        if mirror_path not in _mirror_locks:
+            _mirror_locks[mirror_path] = threading.Lock()
+        return _mirror_locks[mirror_path]
+
+
+def _update_mirror(mirror_path: str, gitlab_repo_url: str, sha: str) -> Repo:
+    """Create or incrementally fetch the bare mirror of a project, making sure it has sha"""
+    try:
+        mirror = Repo(mirror_path)
+        mirror.remotes.origin.set_url(gitlab_repo_url)
+    except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError):
+        shutil.rmtree(mirror_path, ignore_errors=True)
+        mirror = Repo.init(mirror_path, bare=True, mkdir=True)
+        mirror.create_remote('origin', gitlab_repo_url)
+
+    mirror.git.fetch('--prune', 'origin', '+refs/heads/*:refs/heads/*')
+
+    try:
+        mirror.git.cat_file('-e', f'{sha}^{{commit}}')
+    except git.exc.GitCommandError:
+        # pushed commit is no longer on a branch, fetch it directly
+        mirror.git.fetch('origin', sha)
+
+    # mtime of the mirror marks when it was last used
+    os.utime(mirror_path)
+    return mirror
+
+
+def _get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _get_mirror_size(mirror: Repo) -> int:
+    """Bytes used by the objects of a mirror, from git count-objects instead of walking it"""
+    counts = dict(line.split(': ', 1)
+                  for line in mirror.git.count_objects('-v').splitlines())
+    return (int(counts['size']) + int(counts['size-pack'])) * 1024
+
+
+def _record_mirror_size(mirror_path: str, size: int) -> int:
+    """Remember the size of a fetched mirror, returns the size of the mirror store"""
+    global _mirror_sizes
+    mirror_root = os.path.dirname(mirror_path)
+    with _mirror_sizes_lock:
+        if _mirror_sizes is None:
+            _mirror_sizes = {os.path.join(mirror_root, name): _get_dir_size(os.path.join(mirror_root, name))
+                             for name in os.listdir(mirror_root)}
+        _mirror_sizes[mirror_path] = size
+        return sum(_mirror_sizes.values())
+
+
+def _evict_mirrors():
+    """Remove the least recently used mirrors until the mirror store fits its quota"""
+    mirror_settings = _get_mirror_settings()
+
+    with _mirror_sizes_lock:
+        sizes = dict(_mirror_sizes)
+
+    mirrors = []
+    for mirror_path, size in sizes.items():
+        try:
+            mirrors.append((os.path.getmtime(mirror_path), mirror_path, size))
+        except OSError:
+            pass
+
+    total = sum(size for _, _, size in mirrors)
+    for _, mirror_path, size in sorted(mirrors):
+        if total <= mirror_settings['mirrorQuota']:
+            break
+
+        # skip mirrors that are being fetched or cloned from
+        lock = _get_mirror_lock(mirror_path)
+        if not lock.acquire(blocking=False):
+            continue
+
+        try:
+            log(f'Evicting repository mirror {mirror_path} ({size} bytes)')
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            with _mirror_sizes_lock:
+                _mirror_sizes.pop(mirror_path, None)
+            total -= size
+        finally:
+            lock.release()
+
+
+@metrics.timed_call('gitlab')
+def clone(project_id: int, gitlab_url: str, repo_path: str, sha: str):
+    """Check out sha of a project to repo_path, through a local bare mirror of the project"""
     gl_settings = get_settings()['gitlab']
 
     # add credentials to url
     gitlab_repo_url = gitlab_url.replace(
         "https://", f"https://{gl_settings['username']}:{gl_settings['password']}@")
-    Repo.clone_from(gitlab_repo_url, repo_path)
 
+    mirror_root = _get_mirror_settings()['mirrorPath']
+    mirror_path = os.path.join(mirror_root, f"{project_id}.git")
+    os.makedirs(mirror_root, exist_ok=True)
+
+    with _get_mirror_lock(mirror_path):
+        mirror = _update_mirror(mirror_path, gitlab_repo_url, sha)
+        mirror_size = _get_mirror_size(mirror)
+
+        # --local hardlinks the mirror's objects, so the checkout stays
+        # valid after the mirror is fetched again or evicted
+        repo = Repo.clone_from(mirror_path, repo_path,
+                               local=True, no_checkout=True)
+
+    repo.remotes.origin.set_url(gitlab_repo_url)
+    repo.git.checkout('--detach', sha)
 
-def push_results(run_id: str):
+    try:
+        if _record_mirror_size(mirror_path, mirror_size) > _get_mirror_settings()['mirrorQuota']:
+            _evict_mirrors()
+    except Exception as e:
+        log(f'Error evicting repository mirrors. Details: {e}', "ERROR")
+
+
+# Paths that do not change the image, a run writes to outputs/ and secd.yml
+# only configures how the image is run
+TREE_HASH_EXCLUDES = ['outputs/', METADATA_FILE]
+
+
+def get_tree_hash(repo_path: str) -> str:
+    """Hash of the checked out tree without TREE_HASH_EXCLUDES, equal trees build equal images"""
+    tree = Repo(repo_path).git.ls_tree('-r', '--full-tree', 'HEAD')
+
+    digest = hashlib.sha256()
+    for line in tree.splitlines():
+        path = line.split('\t', 1)[1]
+        if any(path == exclude or path.startswith(exclude) for exclude in TREE_HASH_EXCLUDES):
+            continue
+        digest.update(line.encode() + b'\n')
+
+    return digest.hexdigest()
+
+
+def _run_git(repo_path: str, *args: str) -> str:
+    try:
+        result = subprocess.run(["git", *args], check=True, cwd=repo_path,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"git {args[0]} failed: {e.stderr.strip()}")
+
+    return result.stdout
+
+
+@metrics.timed_call('gitlab')
+def push_results(run_id: str, reason: str = None):
+    """Commit the outputs of a run to a new branch and push it, raises if the results could not be pushed.
+
+    reason, why the run finished, is added to the commit message"""
     repo_path = f"{get_settings()['path']['repoPath']}/{run_id}"
 
     date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -144,28 +382,14 @@ def push_results(run_id: str):
     if not os.path.exists(repo_path):
         return
 
-    try:
-        subprocess.run(["git", "checkout", "-b", branch_name], check=True,
-                       cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except Exception:
-        pass
+    # -B so a retry after a failed push reuses the checkout
+    _run_git(repo_path, "checkout", "-B", branch_name)
+    _run_git(repo_path, "add", ".")
 
-    try:
-        subprocess.run(["git", "add", "."], check=True, cwd=repo_path,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except Exception:
-        pass
-
-    try:
-        subprocess.run(["git", "commit", "-m", f'"{commit_message}"'], check=True,
-                       cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except Exception:
-        pass
+    if _run_git(repo_path, "status", "--porcelain").strip():
+        details = ["-m", f"Run finished: {reason}"] if reason else []
+        _run_git(repo_path, "commit", "-m", f'"{commit_message}"', *details)
 
-    try:
-        subprocess.run(["git", "push", "origin", branch_name], check=True,
-                       cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except Exception:
-        pass
+    _run_git(repo_path, "push", "origin", branch_name)
 
     shutil.rmtree(repo_path, ignore_errors=True)
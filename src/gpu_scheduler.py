@@ -0,0 +1,153 @@
+import threading
+import time
+
+import src.k8s_service as k8s_service
+import src.metrics as metrics
+import src.tracing as tracing
+
+from typing import Any, Dict, List, Tuple
+from src.setup import get_settings
+from src.logger import log
+
+# Allocatable GPUs only change when nodes do, so nodes, and the pods of
+# other workloads using their GPUs, are listed at most this often
+NODE_REFRESH = 5 * 60
+
+_cond = threading.Condition()
+_queue: List[Dict[str, Any]] = []
+_notified = False
+# non-terminal GPU run pods by namespace, kept up to date by the daemon's pod watch
+_pods: Dict[str, Any] = {}
+# (allocatable GPUs, GPUs requested by pods that are not run pods)
+_node_state: Tuple[int, int] = None
+_node_state_at = 0.0
+
+metrics.GPU_QUEUED_RUNS.set_function(lambda: len(_queue))
+
+
+def _get_scheduler_settings() -> Dict[str, Any]:
+    scheduler_settings = get_settings().get('scheduler', {})
+    return {
+        'interval': scheduler_settings.get('interval', 30),
+    }
+
+
+def _is_tracked(event_type: str, pod) -> bool:
+    phase = pod.status.phase if pod.status is not None else None
+    return event_type != 'DELETED' and (pod.metadata.labels or {}).get('gpu') == 'true' \
+        and phase not in ['Succeeded', 'Failed']
+
+
+def set_pods(pods: List):
+    """Replace the GPU pods with the run pods of a (re)list"""
+    global _notified
+    with _cond:
+        _pods.clear()
+        for pod in pods:
+            if _is_tracked('ADDED', pod):
+                _pods[pod.metadata.namespace] = pod
+        _notified = True
+        _cond.notify()
+
+
+def update_pod(event_type: str, pod):
+    """Follow a run pod event, checks for free GPUs when GPU pods are added or go away"""
+    global _notified
+    if (pod.metadata.labels or {}).get('gpu') != 'true':
+        return
+
+    with _cond:
+        known = pod.metadata.namespace in _pods
+        if _is_tracked(event_type, pod):
+            _pods[pod.metadata.namespace] = pod
+        else:
+            _pods.pop(pod.metadata.namespace, None)
+
+        if not known or pod.metadata.namespace not in _pods:
+            _notified = True
+            _cond.notify()
+
+
+def get_queue() -> List[Dict[str, Any]]:
+    """GPU runs waiting for admission, in the order of the last admission check"""
+    with _cond:
+        return list(_queue)
+
+
+def _order(gated: List, requested_by_user: Dict[str, int]) -> List:
+    """Fair share, the user with the fewest GPUs goes first, then the oldest pod"""
+    usage = dict(requested_by_user)
+    waiting = list(gated)
+    ordered = []
+    while waiting:
+        pod = min(waiting, key=lambda pod: (
+            usage.get(_get_user_id(pod), 0), pod.metadata.creation_timestamp))
+        waiting.remove(pod)
+        ordered.append(pod)
+        user_id = _get_user_id(pod)
+        usage[user_id] = usage.get(user_id, 0) + k8s_service.get_gpu_request(pod)
+    return ordered
+
+
+def _get_user_id(pod) -> str:
+    return (pod.metadata.annotations or {}).get('userid', '')
+
+
+def _get_node_state() -> Tuple[int, int]:
+    global _node_state, _node_state_at
+    if _node_state is None or time.monotonic() - _node_state_at > NODE_REFRESH:
+        _node_state = (k8s_service.get_gpu_allocatable(),
+                       k8s_service.get_other_gpu_requests())
+        _node_state_at = time.monotonic()
+    return _node_state
+
+
+def _admit():
+    allocatable, other_requested = _get_node_state()
+    with _cond:
+        pods = list(_pods.values())
+    state = k8s_service.get_gpu_state(pods)
+    requested = state['requested'] + other_requested
+    free = allocatable - requested
+
+    metrics.GPU_ALLOCATABLE.set(allocatable)
+    metrics.GPU_REQUESTED.set(requested)
+
+    waiting = []
+    for pod in _order(state['gated'], state['requested_by_user']):
+        run_id = k8s_service.get_run_id(pod.metadata.namespace)
+        gpus = k8s_service.get_gpu_request(pod)
+
+        # strict order, a later run never overtakes one that does not fit yet
+        if waiting or gpus > free:
+            waiting.append({'run_id': run_id, 'user_id': _get_user_id(pod), 'gpus': gpus})
+            continue
+
+        log(f"Admitting GPU run {run_id}, {free - gpus}/{allocatable} GPUs left", run_id=run_id)
+        k8s_service.admit_pod(pod)
+        free -= gpus
+        with _cond:
+            # counted as requested until the watch brings the admitted pod
+            if _pods.get(pod.metadata.namespace) is pod:
+                pod.spec.scheduling_gates = None
+        tracing.record(run_id, 'gpu_admission', pod.metadata.creation_timestamp.timestamp(), time.time(),
+                       gpus=gpus, free=free)
+
+    with _cond:
+        _queue[:] = waiting
+
+
+def run():
+    """Admit gated GPU pods as GPUs become free, checks on pod watch events and every interval"""
+    global _notified
+    log("Starting GPU scheduler...")
+    while True:
+        try:
+            _admit()
+        except Exception as e:
+            log(f"Error admitting GPU runs. Details: {e}", "ERROR")
+
+        with _cond:
+            if not _notified:
+                _cond.wait(_get_scheduler_settings()['interval'])
+            _notified = False
@@ -0,0 +1,101 @@
+import threading
+
+import src.gitlab_service as gitlab_service
+import src.keycloak_service as keycloak_service
+
+from typing import Any, Dict, List, Tuple
+from src.cache import TTLCache
+from src.setup import get_settings
+
+# Distinguishes a cached "user has no identity" from a cache miss
+_MISSING = object()
+
+_lock = threading.Lock()
+_identities: TTLCache = None
+_groups: TTLCache = None
+# the ttl and maxSize the caches were built with
+_cache_settings: Tuple[float, int] = None
+
+
+def _get_identity_settings() -> Dict[str, Any]:
+    identity_settings = get_settings().get('identity', {})
+    return {
+        'ttl': identity_settings.get('ttl', 10 * 60),
+        'negativeTtl': identity_settings.get('negativeTtl', 60),
+        'maxSize': identity_settings.get('maxSize', 1000),
+    }
+
+
+def _get_caches() -> Tuple[TTLCache, TTLCache]:
+    """The identity and group caches, rebuilt empty when a settings reload changed their ttl or maxSize"""
+    global _identities, _groups, _cache_settings
+    identity_settings = _get_identity_settings()
+    cache_settings = (identity_settings['ttl'], identity_settings['maxSize'])
+    with _lock:
+        if _cache_settings != cache_settings:
+            _identities = TTLCache(*cache_settings)
+            _groups = TTLCache(*cache_settings)
+            _cache_settings = cache_settings
+
+    return _identities, _groups
+
+
+def get_keycloak_user_id(gitlab_user_id: int) -> str:
+    """Resolve the Keycloak user id of a GitLab user, users without an identity are cached too.
+
+    Raises when GitLab fails, nothing is cached then"""
+    identities, _ = _get_caches()
+
+    keycloak_user_id = identities.get(gitlab_user_id, _MISSING)
+    if keycloak_user_id is not _MISSING:
+        return keycloak_user_id
+
+    keycloak_user_id = gitlab_service.get_idp_user_id(gitlab_user_id)
+    if keycloak_user_id is None:
+        identities.set(gitlab_user_id, None,
+                       _get_identity_settings()['negativeTtl'])
+    else:
+        identities.set(gitlab_user_id, keycloak_user_id)
+
+    return keycloak_user_id
+
+
+def get_groups(keycloak_user_id: str) -> List[Dict[str, Any]]:
+    """Get the Keycloak groups of a user"""
+    _, groups_cache = _get_caches()
+
+    groups = groups_cache.get(keycloak_user_id)
+    if groups is not None:
+        return groups
+
+    groups = keycloak_service.get_keycloak_user_groups(keycloak_user_id)
+    if groups is not None:
+        groups_cache.set(keycloak_user_id, groups)
+
+    return groups
+
+
+def invalidate(gitlab_user_id: int = None, keycloak_user_id: str = None):
+    """Forget cached identities, everything if no user is given"""
+    identities, groups_cache = _get_caches()
+
+    if gitlab_user_id is None and keycloak_user_id is None:
+        identities.clear()
+        groups_cache.clear()
+        return
+
+    if gitlab_user_id is not None:
+        cached = identities.delete(gitlab_user_id)
+        if cached is not None:
+            groups_cache.delete(cached)
+
+    if keycloak_user_id is not None:
+        groups_cache.delete(keycloak_user_id)
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    identities, groups_cache = _get_caches()
+    return {
+        'identities': identities.get_stats(),
+        'groups': groups_cache.get_stats(),
+    }
@@ -1,60 +1,214 @@
+import contextvars
 import datetime
-from kubernetes import client, config
-from typing import Dict, List
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from typing import Any, Dict, Iterator, List, Tuple
+
+import src.client_registry as client_registry
+import src.metrics as metrics
+import src.run_registry as run_registry
 
 from src.setup import get_settings
 from src.logger import log
 
 
-def _with_k8s():
-    config.load_kube_config(get_settings()['k8s']['configPath'])
-    v1 = client.CoreV1Api()
-    return v1
+def _create_k8s_client() -> client.ApiClient:
+    return config.new_client_from_config(get_settings()['k8s']['configPath'])
 
 
-def create_namespace(user_id: str, run_id: str, run_for: datetime):
-    v1 = _with_k8s()
+def _check_k8s_client(api_client: client.ApiClient) -> bool:
+    client.VersionApi(api_client).get_code()
+    return True
 
-    run_until = datetime.datetime.now() + datetime.timedelta(hours=run_for)
 
-    # create namespace if not exists
-    namespace = client.V1Namespace()
+client_registry.register('k8s', _create_k8s_client,
+                         health_check=_check_k8s_client)
+
+
+def _with_k8s() -> client.CoreV1Api:
+    return client.CoreV1Api(client_registry.get('k8s'))
+
+
+# Every namespace and pod created for a run carries this label, so the
+# daemon can list and watch runs without scanning the whole cluster
+RUN_LABEL = 'secd'
+RUN_LABEL_VALUE = 'run'
+RUN_LABEL_SELECTOR = f'{RUN_LABEL}={RUN_LABEL_VALUE}'
+
+GPU_RESOURCE = 'nvidia.com/gpu'
+
+# Owner of the fields of applied run objects
+FIELD_MANAGER = 'secd'
+
+# Applies the objects of a run concurrently, never used for anything that
+# waits on it
+_apply_executor = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix='secd-k8s')
+
+# GPU pods are created with this scheduling gate, the GPU scheduler removes
+# it once the cluster has a free GPU for the pod
+GPU_SCHEDULING_GATE = 'secd/gpu-admission'
+
+
+def _render_namespace(user_id: str, run_id: str, run_for: float) -> client.V1Namespace:
+    """The namespace of a run, its rununtil is set by start_run_clock once the pod runs"""
+    namespace = client.V1Namespace(api_version='v1', kind='Namespace')
     namespace.metadata = client.V1ObjectMeta(
         name=f"secd-{run_id}",
+        labels={RUN_LABEL: RUN_LABEL_VALUE},
         annotations={
             "userid": user_id,
-            "rununtil": run_until.isoformat(),
+            "runfor": str(run_for),
         }
     )
-    v1.create_namespace(body=namespace)
+    return namespace
 
 
-def create_pod(run_id: str, image: str, envs: Dict[str, str], gpu, mount_path):
+@metrics.timed_call('k8s')
+def start_run_clock(run_id: str, run_for: float):
+    """Set the rununtil annotation of a run to run_for hours from now"""
     v1 = _with_k8s()
 
+    run_until = datetime.datetime.now() + datetime.timedelta(hours=run_for)
+    v1.patch_namespace(name=f"secd-{run_id}", body={
+        'metadata': {'annotations': {'rununtil': run_until.isoformat()}}})
+
+
+def _get_cache_staging_settings() -> Dict[str, Any]:
+    """Settings of node-local cache staging, or None if the cache is mounted from NFS directly"""
+    staging_settings = get_settings()['k8s'].get('cacheStaging')
+    if staging_settings is None:
+        return None
+
+    return {
+        'image': staging_settings['image'],
+        'localPath': staging_settings.get('localPath'),
+        'syncTimeout': staging_settings.get('syncTimeout', 600),
+    }
+
+
+# With a localPath, every node keeps a copy of each cache under
+# base/<cache key>, delta synced from NFS and shared by the user's runs on
+# the node under a flock. A run works in its own copy under runs/<run_id>,
+# seeded from the base copy, so concurrent runs of a user never sync back
+# each other's files. The image needs sh, rsync, flock and timeout.
+#
+# Stage-in also removes run copies left by a failed sync-back and base
+# copies no run used for a while, the sidecar touches its run copy so a
+# running run is never removed.
+LOCAL_RUN_RETENTION_MINUTES = 24 * 60
+LOCAL_BASE_RETENTION_DAYS = 7
+
+CACHE_STAGE_IN_SCRIPT = f"""
+set -e
+mkdir -p /node/base /node/runs
+find /node/runs -mindepth 1 -maxdepth 1 -type d -mmin +{LOCAL_RUN_RETENTION_MINUTES} -exec rm -rf {{}} +
+for base in $(find /node/base -mindepth 1 -maxdepth 1 -type d -mtime +{LOCAL_BASE_RETENTION_DAYS}); do
+    flock "$base.lock" rm -rf "$base"
+done
+mkdir -p "$BASE" "$RUN"
+touch "$BASE"
+flock "$BASE.lock" sh -c 'rsync -a --delete /remote/ "$BASE/" && rsync -a "$BASE/" "$RUN/"'
+"""
+
+# Copies the cache back to NFS when the sidecar is stopped, which happens
+# once the run's container has exited or the pod is deleted. Other runs of
+# the user may have written to NFS since this run staged in, so nothing is
+# deleted there and newer files are kept. The node's base copy is updated
+# the same way and the run's copy is removed once it is safely back.
+CACHE_SYNC_BACK_SCRIPT = """
+trap 'rsync -a --update "$RUN/" /remote/ && flock "$BASE.lock" rsync -a --update "$RUN/" "$BASE/" && rm -rf "$RUN"; exit $?' TERM
+while true; do touch "$RUN"; sleep 600 & wait $!; done
+"""
+
+# Without a localPath the run's copy is an emptyDir that goes away with the pod
+CACHE_STAGE_IN_EMPTY_DIR_SCRIPT = """
+rsync -a /remote/ /local/
+"""
+
+CACHE_SYNC_BACK_EMPTY_DIR_SCRIPT = """
+trap 'rsync -a --update /local/ /remote/; exit $?' TERM
+while true; do sleep 3600 & wait $!; done
+"""
+
+
+def _render_cache_staging(run_id: str, staging_settings: Dict[str, Any], cache_path: str) -> Tuple[client.V1Volume, client.V1VolumeMount, List[client.V1Container]]:
+    """The node-local cache volume, its mount in the run's container and the containers that stage
+    it in from NFS and sync it back"""
+    local_volume = client.V1Volume(name=f'vol-{run_id}-cache-local')
+    volume_mounts = [client.V1VolumeMount(name=f'vol-{run_id}-cache', mount_path='/remote')]
+    env = None
+    if staging_settings['localPath']:
+        local_volume.host_path = client.V1HostPathVolumeSource(
+            path=staging_settings['localPath'], type='DirectoryOrCreate')
+        volume_mounts.append(client.V1VolumeMount(name=local_volume.name, mount_path='/node'))
+        env = [
+            client.V1EnvVar(name='BASE', value=f'/node/base/{hashlib.sha256(cache_path.encode()).hexdigest()[:16]}'),
+            client.V1EnvVar(name='RUN', value=f'/node/runs/{run_id}'),
+        ]
+        run_mount = client.V1VolumeMount(name=local_volume.name, mount_path='', sub_path=f'runs/{run_id}')
+        stage_in, sync_back = CACHE_STAGE_IN_SCRIPT, CACHE_SYNC_BACK_SCRIPT
+    else:
+        local_volume.empty_dir = client.V1EmptyDirVolumeSource()
+        volume_mounts.append(client.V1VolumeMount(name=local_volume.name, mount_path='/local'))
+        run_mount = client.V1VolumeMount(name=local_volume.name, mount_path='')
+        stage_in, sync_back = CACHE_STAGE_IN_EMPTY_DIR_SCRIPT, CACHE_SYNC_BACK_EMPTY_DIR_SCRIPT
+
+    init_containers = [
+        # a stage-in that hangs fails the pod instead of holding its
+        # resources until the start timeout
+        client.V1Container(
+            name='cache-stage-in',
+            image=staging_settings['image'],
+            command=['timeout', str(staging_settings['syncTimeout']), 'sh', '-c', stage_in],
+            env=env,
+            volume_mounts=volume_mounts
+        ),
+        # a native sidecar, it runs next to the run's container and is
+        # stopped after it
+        client.V1Container(
+            name='cache-sync-back',
+            image=staging_settings['image'],
+            command=['sh', '-c', sync_back],
+            env=env,
+            volume_mounts=volume_mounts,
+            restart_policy='Always'
+        ),
+    ]
+    return local_volume, run_mount, init_containers
+
+
+def _render_pod(run_id: str, image: str, envs: Dict[str, str], gpu, mount_path, user_id: str = None, cache_path: str = None) -> client.V1Pod:
     k8s_envs = []
     for env in envs:
         k8s_envs.append(client.V1EnvVar(name=env, value=envs[env]))
 
     resources = client.V1ResourceRequirements()
+    scheduling_gates = None
 
-    labels = {}
+    labels = {RUN_LABEL: RUN_LABEL_VALUE}
     if gpu:
         resources = client.V1ResourceRequirements(
             limits={
-                "nvidia.com/gpu": 1
+                GPU_RESOURCE: "1"
             },
             requests={
-                "nvidia.com/gpu": 1
+                GPU_RESOURCE: "1"
             }
         )
-        labels = {"gpu": "true"}
+        labels["gpu"] = "true"
+        scheduling_gates = [
+            client.V1PodSchedulingGate(name=GPU_SCHEDULING_GATE)]
 
     # Create pod
-    pod = client.V1Pod()
+    pod = client.V1Pod(api_version='v1', kind='Pod')
     pod.metadata = client.V1ObjectMeta(
         name=f"secd-{run_id}",
-        labels=labels
+        namespace=f"secd-{run_id}",
+        labels=labels,
+        annotations={"userid": user_id} if user_id else None
     )
 
     volumes = [
@@ -70,6 +224,8 @@ def create_pod(run_id: str, image: str, envs: Dict[str, str], gpu, mount_path):
         mount_path='/output'
     )]
 
+    init_containers = None
+    termination_grace_period = None
     if mount_path:
         volumes.append(
             client.V1Volume(
@@ -79,15 +235,26 @@ def create_pod(run_id: str, image: str, envs: Dict[str, str], gpu, mount_path):
                 )
             )
         )
-        volume_mounts.append(
-            client.V1VolumeMount(
+
+        staging_settings = _get_cache_staging_settings()
+        if staging_settings is not None and cache_path:
+            local_volume, cache_mount, init_containers = _render_cache_staging(
+                run_id, staging_settings, cache_path)
+            volumes.append(local_volume)
+            cache_mount.mount_path = mount_path
+            termination_grace_period = staging_settings['syncTimeout']
+        else:
+            cache_mount = client.V1VolumeMount(
                 name=f'vol-{run_id}-cache',
                 mount_path=mount_path
             )
-        )
+
+        volume_mounts.append(cache_mount)
 
     pod.spec = client.V1PodSpec(
         volumes=volumes,
+        init_containers=init_containers,
+        termination_grace_period_seconds=termination_grace_period,
         containers=[
             client.V1Container(
                 name=f"secd-{run_id}",
@@ -97,16 +264,96 @@ def create_pod(run_id: str, image: str, envs: Dict[str, str], gpu, mount_path):
                 resources=resources
             )
         ],
-        restart_policy="Never"
+        restart_policy="Never",
+        scheduling_gates=scheduling_gates
     )
-    v1.create_namespaced_pod(namespace=f"secd-{run_id}", body=pod)
+    return pod
+
+
+def get_gpu_request(pod: client.V1Pod) -> int:
+    gpus = 0
+    for container in pod.spec.containers:
+        resources = container.resources
+        if resources is None:
+            continue
+
+        requests = resources.requests or {}
+        limits = resources.limits or {}
+        gpus += int(requests.get(GPU_RESOURCE, limits.get(GPU_RESOURCE, 0)))
+    return gpus
+
+
+def _is_gpu_gated(pod: client.V1Pod) -> bool:
+    return any(gate.name == GPU_SCHEDULING_GATE for gate in pod.spec.scheduling_gates or [])
 
 
-def create_persistent_volume(run_id: str, path: str, type: str = "output"):
+@metrics.timed_call('k8s')
+def get_gpu_allocatable() -> int:
+    """Allocatable GPUs of schedulable nodes"""
     v1 = _with_k8s()
 
-    # Create persistent volume
-    pv = client.V1PersistentVolume()
+    allocatable = 0
+    for node in v1.list_node().items:
+        if node.spec.unschedulable or node.status.allocatable is None:
+            continue
+        allocatable += int(node.status.allocatable.get(GPU_RESOURCE, 0))
+    return allocatable
+
+
+@metrics.timed_call('k8s')
+def get_other_gpu_requests() -> int:
+    """GPUs requested by scheduled, non-terminal pods that are not run pods, such as other workloads on
+    shared nodes"""
+    v1 = _with_k8s()
+
+    pods = v1.list_pod_for_all_namespaces(
+        label_selector=f'{RUN_LABEL}!={RUN_LABEL_VALUE}',
+        field_selector='status.phase!=Succeeded,status.phase!=Failed,spec.nodeName!=')
+    return sum(get_gpu_request(pod) for pod in pods.items)
+
+
+def get_gpu_state(pods: List[client.V1Pod]) -> Dict[str, Any]:
+    """GPUs requested by admitted run pods in total and per run user, and the
+    GPU pods waiting for admission, from the non-terminal run pods"""
+    requested = 0
+    requested_by_user: Dict[str, int] = {}
+    gated = []
+    for pod in pods:
+        gpus = get_gpu_request(pod)
+        if gpus == 0:
+            continue
+
+        if _is_gpu_gated(pod):
+            gated.append(pod)
+            continue
+
+        requested += gpus
+        user_id = (pod.metadata.annotations or {}).get('userid')
+        if user_id is not None:
+            requested_by_user[user_id] = requested_by_user.get(
+                user_id, 0) + gpus
+
+    return {
+        'requested': requested,
+        'requested_by_user': requested_by_user,
+        'gated': gated,
+    }
+
+
+@metrics.timed_call('k8s')
+def admit_pod(pod: client.V1Pod):
+    """Remove the GPU scheduling gate of a pod so it can be scheduled"""
+    v1 = _with_k8s()
+
+    # a list body is sent as a JSON patch
+    v1.patch_namespaced_pod(name=pod.metadata.name, namespace=pod.metadata.namespace,
+                            body=[{'op': 'remove', 'path': '/spec/schedulingGates'}])
+
+
+def _render_persistent_volume(run_id: str, path: str, type: str = "output") -> List[Any]:
+    """The NFS persistent volume of a run and its claim"""
+    pv = client.V1PersistentVolume(
+        api_version='v1', kind='PersistentVolume')
     pv.metadata = client.V1ObjectMeta(name=f'secd-{run_id}-{type}')
     pv.spec = client.V1PersistentVolumeSpec(
         access_modes=["ReadWriteOnce"],
@@ -120,98 +367,238 @@ def create_persistent_volume(run_id: str, path: str, type: str = "output"):
         volume_mode="Filesystem"
     )
 
-    v1.create_persistent_volume(body=pv)
-
-    # Create persistent volume claim
-    pvc = client.V1PersistentVolumeClaim()
-    pvc.metadata = client.V1ObjectMeta(name=f'secd-pvc-{run_id}-{type}')
+    pvc = client.V1PersistentVolumeClaim(
+        api_version='v1', kind='PersistentVolumeClaim')
+    pvc.metadata = client.V1ObjectMeta(
+        name=f'secd-pvc-{run_id}-{type}', namespace=f"secd-{run_id}")
     pvc.spec = client.V1PersistentVolumeClaimSpec(
         access_modes=["ReadWriteOnce"],
-        resources=client.V1ResourceRequirements(
+        resources=client.V1VolumeResourceRequirements(
             requests={"storage": "50Gi"}
         ),
         storage_class_name="nfs",
         volume_name=f'secd-{run_id}-{type}',
         volume_mode="Filesystem"
     )
+    return [pv, pvc]
+
+
+def render_run(run_id: str, user_id: str, run_for: float, image: str, envs: Dict[str, str], gpu, output_path: str,
+               cache_path: str = None, mount_path: str = None) -> List[List[Any]]:
+    """Render every object of a run, grouped in the order they have to be applied in.
+
+    Objects of a group do not depend on each other. Persistent volumes are
+    cluster wide so they go with the namespace, a pod waits for its claims
+    to be bound so they go with the pod."""
+    namespace = _render_namespace(user_id, run_id, run_for)
+    output_pv, output_pvc = _render_persistent_volume(run_id, output_path)
+
+    cluster_objects = [namespace, output_pv]
+    namespaced_objects = [output_pvc]
+    if cache_path:
+        cache_pv, cache_pvc = _render_persistent_volume(
+            run_id, cache_path, "cache")
+        cluster_objects.append(cache_pv)
+        namespaced_objects.append(cache_pvc)
+
+    namespaced_objects.append(
+        _render_pod(run_id, image, envs, gpu, mount_path if cache_path else None, user_id, cache_path))
+    return [cluster_objects, namespaced_objects]
+
+
+def _call(v1: client.CoreV1Api, verb: str, obj: Any, **kwargs) -> Any:
+    """Call the read, patch or delete operation of the kind of obj"""
+    if obj.kind == 'Namespace':
+        operation = f'{verb}_namespace'
+    elif obj.kind == 'PersistentVolume':
+        operation = f'{verb}_persistent_volume'
+    elif obj.kind == 'PersistentVolumeClaim':
+        operation = f'{verb}_namespaced_persistent_volume_claim'
+        kwargs['namespace'] = obj.metadata.namespace
+    elif obj.kind == 'Pod':
+        operation = f'{verb}_namespaced_pod'
+        kwargs['namespace'] = obj.metadata.namespace
+    else:
+        raise Exception(f'Can not apply objects of kind {obj.kind}')
+
+    return getattr(v1, operation)(name=obj.metadata.name, **kwargs)
+
+
+def _exists(v1: client.CoreV1Api, obj: Any) -> bool:
+    try:
+        _call(v1, 'read', obj)
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
+
+
+def _apply(v1: client.CoreV1Api, obj: Any) -> bool:
+    """Server-side apply one object, creating it or taking over its fields.
+
+    Returns whether the object was created. A pod that already exists is
+    left as it is, most of its spec can not be changed."""
+    exists = _exists(v1, obj)
+    if exists and obj.kind == 'Pod':
+        return False
+
+    _call(v1, 'patch', obj,
+          body=v1.api_client.sanitize_for_serialization(obj),
+          field_manager=FIELD_MANAGER,
+          force=True,
+          _content_type='application/apply-patch+yaml')
+    return not exists
+
+
+def _roll_back(v1: client.CoreV1Api, run_id: str, created: List[Any]):
+    """Delete the objects an apply_run created, newest first, objects that existed before are kept"""
+    for obj in reversed(created):
+        try:
+            _call(v1, 'delete', obj)
+        except ApiException as e:
+            if e.status != 404:
+                log(f"Error rolling back {obj.kind} {obj.metadata.name} of run {run_id}. Details: {e}", "ERROR")
+
+
+@metrics.timed_call('k8s')
+def apply_run(run_id: str, groups: List[List[Any]]):
+    """Apply the objects of a run rendered by render_run.
+
+    If any object fails the objects this call created are deleted again,
+    so a retried or restarted launch never deletes a run that was already
+    there."""
+    v1 = _with_k8s()
+
+    created = []
+    try:
+        for group in groups:
+            futures = [_apply_executor.submit(contextvars.copy_context().run, _apply, v1, obj)
+                       for obj in group]
+            # wait for the whole group, so nothing is still being created during a rollback
+            errors = [future.exception() for future in futures]
+            created.extend(obj for obj, future, error in zip(group, futures, errors)
+                           if error is None and future.result())
+            for obj, error in zip(group, errors):
+                if error is not None:
+                    raise Exception(
+                        f'Error applying {obj.kind} {obj.metadata.name}: {error}')
+    except Exception as e:
+        log(f"Error creating resources of run {run_id}, rolling back {len(created)} created objects. Details: {e}",
+            "ERROR")
+        _roll_back(v1, run_id, created)
+        raise
+
+
+@metrics.timed_call('k8s')
+def delete_by_user_id(user_id: str, keep_run_id: str = None, project_id: int = None) -> List[str]:
+    """Delete the active runs of a user, only those of project_id if given, found in the run registry"""
+    run_ids = []
+    for run_id in run_registry.get_active_run_ids(user_id, project_id):
+        if run_id == keep_run_id:
+            continue
 
-    v1.create_namespaced_persistent_volume_claim(
-        body=pvc, namespace=f"secd-{run_id}")
+        log(f"Finishing run secd-{run_id} - new push by userid {user_id} - Delete resources")
+        try:
+            delete_run(run_id)
+        except Exception as e:
+            log(f"Error deleting resources of run {run_id}. Details: {e}", "ERROR")
+            continue
 
+        run_ids.append(run_id)
 
-def delete_by_user_id(user_id: str) -> List[str]:
-    v1 = _with_k8s()
+    return run_ids
 
-    run_ids = []
 
-    # Get all namespaces
-    namespaces = v1.list_namespace()
-    for namespace in namespaces.items:
-        # Get annotations
+def get_run_id(namespace_name: str) -> str:
+    return namespace_name.replace("secd-", "")
+
+
+@metrics.timed_call('k8s')
+def label_legacy_runs():
+    """Label run namespaces and pods created before runs were labeled"""
+    v1 = _with_k8s()
+
+    for namespace in v1.list_namespace().items:
         annotations = namespace.metadata.annotations
-        if annotations is None:
+        if annotations is None or 'rununtil' not in annotations:
             continue
 
-        if 'userid' not in annotations:
+        labels = namespace.metadata.labels or {}
+        if labels.get(RUN_LABEL) == RUN_LABEL_VALUE:
             continue
 
-        # Get userid annotations
-        k8s_user_id = annotations.get('userid')
+        name = namespace.metadata.name
+        log(f"Labeling legacy run namespace {name}")
+        patch = {'metadata': {'labels': {RUN_LABEL: RUN_LABEL_VALUE}}}
+        v1.patch_namespace(name=name, body=patch)
+        for pod in v1.list_namespaced_pod(namespace=name).items:
+            v1.patch_namespaced_pod(
+                name=pod.metadata.name, namespace=name, body=patch)
 
-        if user_id == k8s_user_id:
-            run_id = namespace.metadata.name.replace("secd-", "")
 
-            log(f"Finishing run {namespace.metadata.name} - new push by userid {user_id} - Delete resources")
-            v1.delete_namespace(name=namespace.metadata.name)
-            v1.delete_persistent_volume(
-                name=f'{namespace.metadata.name}-output')
+@metrics.timed_call('k8s')
+def list_runs() -> Tuple[List[client.V1Namespace], str]:
+    """List run namespaces, returns the items and the resource version to watch from"""
+    v1 = _with_k8s()
 
-            run_ids.append(run_id)
+    namespaces = v1.list_namespace(label_selector=RUN_LABEL_SELECTOR)
+    return namespaces.items, namespaces.metadata.resource_version
 
-    return run_ids
+
+@metrics.timed_call('k8s')
+def list_run_pods() -> Tuple[List[client.V1Pod], str]:
+    """List run pods, returns the items and the resource version to watch from"""
+    v1 = _with_k8s()
+
+    pods = v1.list_pod_for_all_namespaces(label_selector=RUN_LABEL_SELECTOR)
+    return pods.items, pods.metadata.resource_version
 
 
-def cleanup_resources() -> List[str]:
+def watch_runs(resource_version: str) -> Iterator[Dict[str, any]]:
+    """Stream namespace events for runs, raises ApiException 410 when the version is too old"""
     v1 = _with_k8s()
 
-    run_ids = []
+    return watch.Watch().stream(v1.list_namespace, label_selector=RUN_LABEL_SELECTOR,
+                                resource_version=resource_version)
 
-    # Get all namespaces
-    namespaces = v1.list_namespace()
-    for namespace in namespaces.items:
-        # Get annotations
-        annotations = namespace.metadata.annotations
-        if annotations is None:
-            continue
 
-        if 'rununtil' not in annotations:
-            continue
+def watch_run_pods(resource_version: str) -> Iterator[Dict[str, any]]:
+    """Stream pod events for runs, raises ApiException 410 when the version is too old"""
+    v1 = _with_k8s()
 
-        # Check rununtil expiration
-        rununtil = annotations.get('rununtil')
-        expired = datetime.datetime.fromisoformat(
-            rununtil) < datetime.datetime.now()
+    return watch.Watch().stream(v1.list_pod_for_all_namespaces, label_selector=RUN_LABEL_SELECTOR,
+                                resource_version=resource_version)
 
-        completed = False
-        # Check if pod is completed
-        pod = v1.list_namespaced_pod(namespace=namespace.metadata.name)
-        if len(pod.items) > 0:
-            pod = pod.items[0]
-            if pod.status.phase == 'Succeeded':
-                completed = True
 
-        if expired or completed:
-            run_id = namespace.metadata.name.replace("secd-", "")
+@metrics.timed_call('k8s')
+def run_exists(run_id: str) -> bool:
+    """Whether the namespace of a run exists"""
+    v1 = _with_k8s()
 
-            log(f"Finishing run {namespace.metadata.name} - expired rununtil {rununtil} - Delete resources")
-            v1.delete_namespace(name=namespace.metadata.name)
+    try:
+        v1.read_namespace(name=f"secd-{run_id}")
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
 
-            try:
-                v1.delete_persistent_volume(
-                    name=f'{namespace.metadata.name}-output')
-            except:
-                pass
 
-            run_ids.append(run_id)
+@metrics.timed_call('k8s')
+def delete_run(run_id: str):
+    """Delete the namespace and persistent volumes of a run"""
+    v1 = _with_k8s()
 
-    return run_ids
+    try:
+        v1.delete_namespace(name=f"secd-{run_id}")
+    except ApiException as e:
+        if e.status != 404:
+            raise
+
+    for type in ["output", "cache"]:
+        try:
+            v1.delete_persistent_volume(name=f'secd-{run_id}-{type}')
+        except ApiException as e:
+            if e.status != 404:
+                log(f"Error deleting persistent volume secd-{run_id}-{type}. Details: {e}", "ERROR")
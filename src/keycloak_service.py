@@ -1,11 +1,14 @@
 import keycloak
 
+import src.client_registry as client_registry
+import src.metrics as metrics
+
 from typing import List
 from src.setup import get_settings
 from src.logger import log
 
 
-def _with_keycloak_client() -> keycloak.KeycloakAdmin:
+def _create_keycloak_client() -> keycloak.KeycloakAdmin:
     kcSettings = get_settings()['keycloak']
     client = keycloak.KeycloakAdmin(
         server_url=kcSettings['url'],
@@ -18,11 +21,26 @@ def _with_keycloak_client() -> keycloak.KeycloakAdmin:
     return client
 
 
+# The admin client refreshes its access token by itself, so one login is
+# shared by every caller until the refresh token is rejected
+client_registry.register('keycloak', _create_keycloak_client)
+
+
+def _with_keycloak_client() -> keycloak.KeycloakAdmin:
+    return client_registry.get('keycloak')
+
+
+@metrics.timed_call('keycloak')
 def get_keycloak_user_groups(keycloak_user_id: str) -> List[str]:
     client = _with_keycloak_client()
 
     try:
         groups = client.get_user_groups(keycloak_user_id)
+    except keycloak.exceptions.KeycloakAuthenticationError as e:
+        log(f'Keycloak session expired, logging in again. Details: {e}')
+        client_registry.invalidate('keycloak')
+        client = _with_keycloak_client()
+        groups = client.get_user_groups(keycloak_user_id)
     except keycloak.exceptions.KeycloakGetError as e:
         log(f'User {keycloak_user_id} not found. Details: {e}', "ERROR")
         return None
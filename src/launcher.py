@@ -0,0 +1,255 @@
+import datetime
+import os
+import shutil
+
+import src.finalizer as finalizer
+import src.gitlab_service as gitlab_service
+import src.identity_service as identity_service
+import src.mysql_service as mysql_service
+import src.docker_service as docker_service
+import src.k8s_service as k8s_service
+import src.pipeline as pipeline
+import src.run_registry as run_registry
+import src.tracing as tracing
+
+from typing import Any, Dict, List
+from src.pipeline import Stage
+from src.setup import get_settings
+from src.logger import log
+
+
+def _get_stages(run_id: str, body: Dict[str, Any], image_locks: List[str]) -> List[Stage]:
+    """Stage graph of a launch, independent stages run concurrently.
+
+    The image stage locks the image tag until the push stage is done, the
+    locked tag is kept in image_locks so the caller can unlock it if the
+    launch fails in between."""
+    repo_path = f"{get_settings()['path']['repoPath']}/{run_id}"
+    pvc_repo_path = get_settings()['k8s']['pvcPath']
+    date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    reg_settings = get_settings()['registry']
+    image_repository = f"{reg_settings['url']}/{reg_settings['project']}/{body['project_id']}"
+    cache_image = docker_service.get_cache_image(body['project_id'])
+
+    def metadata(results):
+        # validated by the hook before the run was queued
+        preflight = gitlab_service.get_preflight(
+            body['project_id'], body['checkout_sha'])
+        if preflight['error'] is not None:
+            raise Exception(preflight['error'])
+
+        return preflight['metadata']
+
+    def identity(results):
+        gitlab_user_id = body['user_id']
+        keycloak_user_id = identity_service.get_keycloak_user_id(
+            gitlab_user_id)
+        if keycloak_user_id is None:
+            raise Exception(
+                f'GitLab user {gitlab_user_id} has no Keycloak identity')
+
+        return keycloak_user_id
+
+    def db_user(results):
+        keycloak_user_id = results['identity']
+        keycloak_groups = identity_service.get_groups(keycloak_user_id)
+        if keycloak_groups is None:
+            raise Exception(f'Keycloak user {keycloak_user_id} not found')
+
+        # create db user with groups
+        mysql_groups = []
+        for group in keycloak_groups:
+            prefix = '/mysql_'
+            if group['path'].startswith(prefix):
+                mysql_groups.append(group['path'][len(prefix):])
+
+        return mysql_service.create_mysql_user(run_id, mysql_groups)
+
+    def clone(results):
+        shutil.rmtree(repo_path, ignore_errors=True)
+        gitlab_service.clone(body['project_id'], body["project"]["http_url"],
+                             repo_path, body['checkout_sha'])
+
+        # Create an output folder for the run
+        os.makedirs(f'{repo_path}/outputs/{date}-{run_id}')
+
+    def image(results):
+        """Name the image after the source tree, returns the name and whether the registry has it"""
+        image_name = f"{image_repository}:{gitlab_service.get_tree_hash(repo_path)}"
+        run_registry.set_state(run_id, 'building', image=image_name)
+
+        # another run of the same tree may be building the image, it is looked up once that run pushed it
+        if image_name not in image_locks:
+            docker_service.lock_image(image_name)
+            image_locks.append(image_name)
+
+        exists = docker_service.image_exists(image_name, run_id)
+        if exists:
+            log(f"Image {image_name} of the same source tree exists, skipping build")
+            _unlock_images(image_locks)
+
+        return image_name, exists
+
+    def build(results):
+        image_name, exists = results['image']
+        if not exists:
+            docker_service.build_image(
+                repo_path, image_name, cache_image, run_id)
+
+    def push(results):
+        image_name, exists = results['image']
+        if not exists:
+            docker_service.push_and_remove_image(
+                image_name, cache_image, run_id)
+            _unlock_images(image_locks)
+
+    def supersede(results):
+        """Stop the user's older runs of the same project once the new run is applied, if queue.supersede is set.
+
+        Best effort, the new run is launched whether or not its older runs could be stopped"""
+        if not get_settings().get('queue', {}).get('supersede', False):
+            return []
+
+        try:
+            run_ids = k8s_service.delete_by_user_id(
+                results['identity'], run_id, body['project_id'])
+        except Exception as e:
+            log(f"Error superseding older runs. Details: {e}", "ERROR")
+            return []
+
+        if run_ids:
+            log(f"Superseded runs {', '.join(run_ids)}")
+            for superseded_run_id in run_ids:
+                try:
+                    finalizer.submit(superseded_run_id, f'superseded by run {run_id}')
+                except Exception as e:
+                    log(f"Error finalizing superseded run {superseded_run_id}. Details: {e}", "ERROR")
+            try:
+                mysql_service.delete_mysql_users(run_ids)
+            except Exception as e:
+                log(f"Error dropping database users of superseded runs {', '.join(run_ids)}. Details: {e}", "ERROR")
+
+        return run_ids
+
+    def cache_dir(results):
+        """Create the cache_dir if it is set, returns its mount_path and path on the NFS server or None"""
+        run_meta = results['metadata']
+        keycloak_user_id = results['identity']
+        if "cache_dir" not in run_meta or not run_meta["cache_dir"]:
+            return None
+
+        # Default mount_path inside container
+        mount_path = '/cache'
+
+        # Find and fetch custom mount_path if specified
+        if "mount_path" in run_meta and run_meta["mount_path"]:
+            mount_path = run_meta['mount_path']
+            log(f"Found custom mount_path: {mount_path}")
+
+        # Fetch cache_dir
+        cache_dir = run_meta['cache_dir']
+        cache_path = f"{get_settings()['path']['cachePath']}/{keycloak_user_id}/{cache_dir}"
+        log(f"Found cache_dir: {cache_path}")
+
+        # Create cache_dir if not exists
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+        return mount_path, f'{pvc_repo_path}/cache/{keycloak_user_id}/{cache_dir}'
+
+    def resources(results):
+        """Apply the namespace, volumes and pod of the run together, nothing is left behind if one fails"""
+        db_user, db_pass = results['db_user']
+        image_name, _ = results['image']
+        mount_path, cache_path = results['cache_dir'] or (None, None)
+
+        objects = k8s_service.render_run(
+            run_id, results['identity'], results['metadata']['runfor'], image_name, {
+                "DB_USER": db_user,
+                "DB_PASS": db_pass,
+                "DB_HOST": 'mysql.mysql.svc.cluster.local',
+                "OUTPUT_PATH": '/output',
+                "SECD": 'PRODUCTION'
+            }, results['metadata']['gpu'],
+            f'{pvc_repo_path}/repos/{run_id}/outputs/{date}-{run_id}',
+            cache_path, mount_path)
+        k8s_service.apply_run(run_id, objects)
+
+        run_registry.set_state(run_id, 'running', user_id=results['identity'], namespace=f'secd-{run_id}',
+                               resources=[f'{obj.kind}/{obj.metadata.name}' for group in objects for obj in group],
+                               db_user=db_user)
+
+    return [
+        Stage('metadata', metadata, retries=2),
+        Stage('identity', identity, retries=2),
+        Stage('db_user', db_user, ['identity'], retries=2),
+        Stage('clone', clone, retries=2),
+        Stage('image', image, ['clone'], retries=2),
+        Stage('build', build, ['image']),
+        Stage('push', push, ['build'], retries=2),
+        Stage('cache_dir', cache_dir, ['identity', 'metadata']),
+        Stage('resources', resources, ['metadata', 'identity', 'image', 'push', 'db_user',
+              'cache_dir']),
+        Stage('supersede', supersede, ['identity', 'resources']),
+    ]
+
+
+def _unlock_images(image_locks: List[str]):
+    while image_locks:
+        docker_service.unlock_image(image_locks.pop())
+
+
+def _drop_db_user(run_id: str):
+    """Drop the database user of a launch that failed, no namespace exists for the daemon to clean up"""
+    try:
+        mysql_service.delete_mysql_users([run_id])
+    except Exception as e:
+        log(f"Error dropping database user of failed run {run_id}. Details: {e}", "ERROR")
+
+
+def _is_launched(run_id: str) -> bool:
+    """Whether an earlier launch of a run requeued by a restart got far enough to skip this one.
+
+    A run that got its namespace is left to the daemon, it reaps the run
+    if its pod never starts. A run that failed stays failed."""
+    run = run_registry.get(run_id)
+    if run is None or run['state'] == 'queued':
+        return False
+
+    if run['state'] == 'failed':
+        raise Exception(run['error'] or 'Run failed before a restart')
+
+    if run['state'] in ['running', 'finalizing', 'done']:
+        log(f"Run {run_id} was launched before a restart, skipping")
+        return True
+
+    if k8s_service.run_exists(run_id):
+        log(f"Run {run_id} was interrupted by a restart after its namespace was created, resuming it as running")
+        run_registry.set_state(run_id, 'running', namespace=f'secd-{run_id}')
+        return True
+
+    return False
+
+
+def create(run_id: str, body: Dict[str, Any]):
+    """Launch a run for a validated push hook body, raises on failure.
+
+    Runs requeued by a restart that were already launched are skipped."""
+    if _is_launched(run_id):
+        return
+
+    run_registry.set_state(run_id, 'cloning', project_id=body['project_id'], gitlab_user_id=body['user_id'],
+                           checkout_sha=body['checkout_sha'])
+    image_locks = []
+    try:
+        with tracing.span('create', run_id=run_id):
+            pipeline.run(f"Run {run_id}", _get_stages(run_id, body, image_locks))
+    except Exception as e:
+        run_registry.set_state(run_id, 'failed', error=str(e))
+        _drop_db_user(run_id)
+        raise
+    finally:
+        _unlock_images(image_locks)
+
+    log(f"Successfully launched {run_id}")
@@ -1,13 +1,130 @@
+import atexit
+import contextlib
+import contextvars
 import datetime
+import os
+import queue
+import random
 import sys
+import threading
+import time
+import orjson
+
+from typing import Any, Dict
+
+LEVELS = {
+    'DEBUG': 10,
+    'INFO': 20,
+    'WARNING': 30,
+    'ERROR': 40,
+}
+
+# Lines are only formatted and written by the writer thread, callers just
+# enqueue. When the queue is full lines are dropped and counted instead of
+# blocking the caller.
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+
+_level = LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), LEVELS['INFO'])
+_context: contextvars.ContextVar = contextvars.ContextVar(
+    'secd_log_context', default={})
+_queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+_writer_lock = threading.Lock()
+_writer: threading.Thread = None
+_dropped = 0
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def log(message: str, level: str = "INFO"):
-    date = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    output = f"[secd] [{level}] [{date}] {message}"
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach fields such as run_id, project_id, user_id or stage to every log line in this context"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def get_log_context() -> Dict[str, Any]:
+    return dict(_context.get())
+
+
+def log(message: str, level: str = "INFO", sample: float = None, **fields):
+    """Log a line, sample is the probability in [0, 1] that the line is kept"""
+    if LEVELS.get(level, LEVELS['INFO']) < _level:
+        return
+
+    if sample is not None and random.random() >= sample:
+        return
+
+    _start_writer()
+
+    record = (time.time(), level, message, {**_context.get(), **fields})
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        global _dropped
+        _dropped += 1
+
+
+def _format(record) -> bytes:
+    created, level, message, fields = record
+    date = datetime.datetime.fromtimestamp(
+        created).isoformat(timespec='milliseconds')
+    return orjson.dumps({'time': date, 'level': level, 'message': message, **fields},
+                        default=str) + b'\n'
+
+
+def _write():
+    global _dropped
+    while True:
+        records = [_queue.get()]
+        while len(records) < BATCH_SIZE:
+            try:
+                records.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = [_format(record) for record in records]
+        if _dropped > 0:
+            dropped, _dropped = _dropped, 0
+            lines.append(_format((time.time(), 'WARNING',
+                         f'Dropped {dropped} log lines', {})))
+
+        try:
+            stream = getattr(sys.stderr, 'buffer', None)
+            if stream is not None:
+                stream.write(b''.join(lines))
+            else:
+                sys.stderr.write(b''.join(lines).decode())
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+        for _ in records:
+            _queue.task_done()
+
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(
+                target=_write, name='secd-logger', daemon=True)
+            _writer.start()
+
+
+def flush(timeout: float = 5):
+    """Wait until queued lines are written"""
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
 
-    eprint(output)
+atexit.register(flush)
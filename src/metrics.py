@@ -0,0 +1,119 @@
+import contextlib
+import functools
+import time
+
+import src.client_registry as client_registry
+import src.tracing as tracing
+
+from typing import Callable
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Launch stages take from milliseconds (lookups) to tens of minutes (builds)
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                 120, 300, 600, 1200, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'secd_http_request_seconds', 'Time spent handling HTTP requests', ['route', 'method', 'status'])
+
+STAGE_SECONDS = Histogram(
+    'secd_stage_seconds', 'Duration of run stages, from the webhook checks to the pod start', ['stage'], buckets=STAGE_BUCKETS)
+
+CLIENT_CALLS = Counter(
+    'secd_client_calls_total', 'Calls to external services', ['client', 'operation'])
+CLIENT_ERRORS = Counter(
+    'secd_client_errors_total', 'Failed calls to external services', ['client', 'operation'])
+CLIENT_SECONDS = Histogram(
+    'secd_client_call_seconds', 'Duration of calls to external services', ['client', 'operation'], buckets=STAGE_BUCKETS)
+
+ACTIVE_RUNS = Gauge('secd_active_runs', 'Runs with resources in the cluster')
+QUEUED_RUNS = Gauge('secd_queued_runs', 'Runs waiting in the run queue')
+GPU_RUNS = Gauge('secd_gpu_runs', 'Runs with a pending or running GPU pod')
+GPU_QUEUED_RUNS = Gauge('secd_gpu_queued_runs',
+                        'GPU runs waiting for a free GPU')
+GPU_ALLOCATABLE = Gauge('secd_gpu_allocatable',
+                        'Allocatable GPUs of schedulable nodes')
+GPU_REQUESTED = Gauge('secd_gpu_requested',
+                      'GPUs requested by admitted run pods and scheduled pods of other workloads')
+IMAGE_CACHE = Counter('secd_image_cache_total',
+                      'Image lookups by whether the registry already had the image of the source tree', ['result'])
+RECLAIMED_RUNS = Counter('secd_reclaimed_runs_total',
+                         'Runs reaped early because their pod failed or could not start', ['failure'])
+PUSHES = Counter('secd_pushes_total',
+                 'Accepted pushes by how they were queued', ['outcome'])
+
+PENDING_FINALIZATIONS = Gauge(
+    'secd_pending_finalizations', 'Finished runs waiting to have their results pushed')
+FAILED_FINALIZATIONS = Gauge(
+    'secd_failed_finalizations', 'Finished runs whose results could not be pushed')
+
+REAPER_CYCLE_SECONDS = Histogram(
+    'secd_reaper_cycle_seconds', 'Time the reaper spends finishing the runs that are due', buckets=STAGE_BUCKETS)
+
+
+@contextlib.contextmanager
+def client_call(client: str, operation: str):
+    """Count and time a call to an external service, as a span of the current run if there is one"""
+    CLIENT_CALLS.labels(client, operation).inc()
+    start = time.monotonic()
+    try:
+        with tracing.span(f'{client}.{operation}', client=client, operation=operation):
+            yield
+    except Exception:
+        CLIENT_ERRORS.labels(client, operation).inc()
+        raise
+    finally:
+        CLIENT_SECONDS.labels(client, operation).observe(
+            time.monotonic() - start)
+
+
+def timed_call(client: str) -> Callable:
+    """Decorator that counts and times every call of a function as a call to client"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with client_call(client, fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class HttpMetricsMiddleware:
+    """Falcon middleware that times every request by route template"""
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.monotonic()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'metrics_start', None)
+        if start is None:
+            return
+
+        route = req.uri_template or 'unknown'
+        HTTP_REQUEST_SECONDS.labels(route, req.method, str(resp.status)[:3]).observe(
+            time.monotonic() - start)
+
+
+class _ClientRegistryCollector:
+    """Exports the reuse and reconnect counters of the shared service clients"""
+
+    def collect(self):
+        stats = client_registry.get_stats()
+
+        counters = {}
+        for stat in ['created', 'reused', 'reconnects', 'health_failures']:
+            counters[stat] = CounterMetricFamily(
+                f'secd_client_{stat}', f'Shared service clients {stat.replace("_", " ")}', labels=['client'])
+        connected = GaugeMetricFamily(
+            'secd_client_connected', 'Whether a shared service client exists', labels=['client'])
+
+        for name, client_stats in stats.items():
+            for stat, counter in counters.items():
+                counter.add_metric([name], client_stats[stat])
+            connected.add_metric([name], 1 if client_stats['connected'] else 0)
+
+        yield from counters.values()
+        yield connected
+
+
+REGISTRY.register(_ClientRegistryCollector())
@@ -1,46 +1,132 @@
+import threading
 import time
 import mysql.connector
+import mysql.connector.pooling
 import uuid
 
-from typing import List
+import src.client_registry as client_registry
+import src.metrics as metrics
+
+from typing import List, Set
 from src.setup import get_settings
 
 
-def _with_mysql_client() -> mysql.connector.MySQLConnection:
+def _create_mysql_pool() -> mysql.connector.pooling.MySQLConnectionPool:
     msqlSettings = get_settings()['db']
-    client = mysql.connector.connect(
+    pool = mysql.connector.pooling.MySQLConnectionPool(
+        pool_name='secd',
+        pool_size=msqlSettings.get('poolSize', 5),
+        pool_reset_session=False,
         host=msqlSettings['host'],
         user=msqlSettings['username'],
         password=msqlSettings['password'],
     )
 
-    return client
+    return pool
 
 
-def create_mysql_user(groups: List[str]):
-    client = _with_mysql_client()
+def _close_mysql_pool(pool: mysql.connector.pooling.MySQLConnectionPool):
+    """Close the idle connections of a pool, borrowed ones are closed when handed back.
+
+    MySQLConnectionPool has no public close, _remove_connections is the
+    method the driver uses itself and exists in mysql-connector-python 8.0
+    through at least 9.x."""
+    if hasattr(pool, '_remove_connections'):
+        pool._remove_connections()
+
+
+# Pooled connections are pinged and reconnected by the pool when handed out
+client_registry.register('mysql', _create_mysql_pool, close=_close_mysql_pool)
+
+
+def _with_mysql_client() -> mysql.connector.pooling.PooledMySQLConnection:
+    """Borrow a connection from the shared pool, close() hands it back.
+
+    Queue workers, supersede and the reaper share the pool, so a borrower
+    waits up to db.poolTimeout seconds for a connection instead of failing
+    as soon as all are in use"""
+    deadline = time.monotonic() + get_settings()['db'].get('poolTimeout', 30)
+    delay = 0.05
+    while True:
+        try:
+            return client_registry.get('mysql').get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+
+# Roles that have been created and granted by this process, so they are
+# only provisioned once
+_roles_lock = threading.Lock()
+_provisioned_roles: Set[str] = set()
+
+
+def get_db_user(run_id: str) -> str:
+    """Database user of a run, derived from the run id so it can be dropped by run id"""
+    # MySQL user names are at most 32 characters
+    return f"secd{run_id[:28]}"
+
+
+def _execute_script(client, statements: List[str]):
+    """Execute several statements in one round-trip.
+
+    execute() only accepts several statements and nextset() only walks their
+    results since mysql-connector-python 9.2, see requirements.txt"""
     cursor = client.cursor()
+    cursor.execute(' '.join(statements))
+    while cursor.nextset():
+        pass
+    cursor.close()
+
 
-    # Create user
-    db_user = str(uuid.uuid4()).replace('-', '')
+@metrics.timed_call('mysql')
+def create_mysql_user(run_id: str, groups: List[str]):
+    db_user = get_db_user(run_id)
     db_pass = str(uuid.uuid4()).replace('-', '')
 
-    cursor.execute(f"drop user if exists '{db_user}';")
-    cursor.execute(f"create user '{db_user}' identified by '{db_pass}';")
+    with _roles_lock:
+        new_roles = [group for group in groups if group not in _provisioned_roles]
+
+    # Roles and grants are DDL and commit implicitly in MySQL, so the batch
+    # is one round-trip rather than one transaction
+    statements = []
+    if len(new_roles) > 0:
+        roles = ', '.join(f"'{group}'" for group in new_roles)
+        statements.append(f"create role if not exists {roles};")
+        statements.append(f"grant select on build_test.* to {roles};")
 
-    # Create and assign groups
-    for group in groups:
-        cursor.execute(f"create role if not exists '{group}';")
-        cursor.execute(f"grant select on build_test.* to '{group}';")
-        cursor.execute(f"grant '{group}' to '{db_user}';")
+    statements.append(f"drop user if exists '{db_user}';")
+    statements.append(f"create user '{db_user}' identified by '{db_pass}';")
 
     if len(groups) > 0:
-        cursor.execute(
-            f"alter user '{db_user}' default role {', '.join(groups)};")
+        roles = ', '.join(f"'{group}'" for group in groups)
+        statements.append(f"grant {roles} to '{db_user}';")
+        statements.append(f"alter user '{db_user}' default role {roles};")
+
+    client = _with_mysql_client()
+    try:
+        _execute_script(client, statements)
+    finally:
+        client.close()
+
+    with _roles_lock:
+        _provisioned_roles.update(new_roles)
 
     return db_user, db_pass
 
 
-def delete_mysql_user(db_user: str):
+@metrics.timed_call('mysql')
+def delete_mysql_users(run_ids: List[str]):
+    """Drop the database users of several runs in one statement"""
+    if len(run_ids) == 0:
+        return
+
+    db_users = ', '.join(f"'{get_db_user(run_id)}'" for run_id in run_ids)
+
     client = _with_mysql_client()
-    client.execute(f"drop user if exists '{db_user}';")
+    try:
+        _execute_script(client, [f"drop user if exists {db_users};"])
+    finally:
+        client.close()
@@ -0,0 +1,109 @@
+import contextvars
+import threading
+import time
+
+import src.metrics as metrics
+import src.tracing as tracing
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List
+from src.logger import log, log_context
+
+# Shared by all pipelines, stages never submit work themselves so a
+# pipeline can not starve on its own stages
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='secd-stage')
+
+
+class Stage:
+    """A step of a pipeline, fn gets the results of all finished stages keyed by stage name"""
+
+    def __init__(self, name: str, fn: Callable[[Dict[str, Any]], Any], deps: List[str] = None, retries: int = 0, retry_delay: float = 2):
+        self.name = name
+        self.fn = fn
+        self.deps = deps or []
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+class CancelledError(Exception):
+    pass
+
+
+def _run_stage(pipeline_name: str, stage: Stage, results: Dict[str, Any], cancel: threading.Event) -> Any:
+    with log_context(stage=stage.name):
+        return _run_stage_attempts(pipeline_name, stage, results, cancel)
+
+
+def _run_stage_attempts(pipeline_name: str, stage: Stage, results: Dict[str, Any], cancel: threading.Event) -> Any:
+    attempt = 0
+    while True:
+        if cancel.is_set():
+            raise CancelledError(f'{pipeline_name} was cancelled')
+
+        start = time.monotonic()
+        try:
+            # every attempt is a span, so retry delays show as gaps
+            with tracing.span(stage.name, stage=stage.name, attempt=attempt + 1):
+                result = stage.fn(results)
+        except Exception as e:
+            if attempt >= stage.retries or cancel.is_set():
+                raise
+
+            attempt += 1
+            log(f"{pipeline_name} - stage {stage.name} failed, retry {attempt}/{stage.retries}. Details: {e}", "ERROR")
+            cancel.wait(stage.retry_delay * attempt)
+            continue
+
+        duration = time.monotonic() - start
+        metrics.STAGE_SECONDS.labels(stage.name).observe(duration)
+        log(f"{pipeline_name} - stage {stage.name} finished in {duration:.1f}s")
+        return result
+
+
+def run(pipeline_name: str, stages: List[Stage]) -> Dict[str, Any]:
+    """Run stages as soon as their dependencies have finished, returns the results keyed by stage name.
+
+    The first failing stage cancels every stage that has not started yet and
+    its error is raised once the running stages have finished."""
+    # set by the first failure, stops retries and stages that have not started
+    cancel = threading.Event()
+
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise Exception(f'Stage {stage.name} depends on unknown stage {dep}')
+
+    results: Dict[str, Any] = {}
+    pending = dict(by_name)
+    running: Dict[Future, str] = {}
+    error = None
+
+    while pending or running:
+        if error is None:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    del pending[name]
+                    # stages log with the context of the pipeline's caller
+                    running[_executor.submit(contextvars.copy_context().run,
+                                             _run_stage, pipeline_name, stage, dict(results), cancel)] = name
+
+        if not running:
+            if error is None:
+                raise Exception(f'{pipeline_name} has a dependency cycle between {", ".join(pending)}')
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                if error is None:
+                    error = Exception(f'{pipeline_name} - stage {name} failed: {e}')
+                    cancel.set()
+
+    if error is not None:
+        raise error
+
+    return results
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import threading
+import time
+
+import src.metrics as metrics
+import src.state_db as state_db
+import src.tracing as tracing
+
+from typing import Any, Callable, Dict, Tuple
+from src.setup import get_settings
+from src.logger import log, log_context
+
+# Finished jobs are kept this long for queue statistics
+RETENTION = 7 * 24 * 60 * 60
+
+_queue: state_db.WorkQueue = None
+_handler: Callable[[str, Dict[str, Any]], None] = None
+
+
+def _get_depth() -> int:
+    if _queue is None:
+        return 0
+
+    with _queue.cond:
+        (depth,) = _queue.db.execute(
+            "select count(*) from jobs where state = 'queued'").fetchone()
+    return depth
+
+
+metrics.QUEUED_RUNS.set_function(_get_depth)
+
+
+def _get_queue_settings() -> Dict[str, Any]:
+    queue_settings = get_settings().get('queue', {})
+    return {
+        'path': queue_settings.get('path', state_db.get_state_path('secd-queue.db')),
+        'workers': queue_settings.get('workers', 2),
+        'maxSize': queue_settings.get('maxSize', 50),
+        'debounce': queue_settings.get('debounce', 5),
+    }
+
+
+def _open(path: str) -> sqlite3.Connection:
+    db = state_db.connect(path)
+    db.execute('''create table if not exists jobs (
+        run_id text primary key,
+        payload text not null,
+        state text not null,
+        enqueued_at real not null,
+        started_at real,
+        finished_at real,
+        error text
+    )''')
+    db.execute(
+        'create index if not exists jobs_state on jobs (state, enqueued_at)')
+
+    # columns added for coalescing, queues created before have none of them
+    columns = [row[1] for row in db.execute('pragma table_info(jobs)')]
+    if 'project_id' not in columns:
+        db.execute('alter table jobs add column project_id integer')
+        db.execute('alter table jobs add column not_before real not null default 0')
+    if 'user_id' not in columns:
+        db.execute('alter table jobs add column user_id integer')
+    db.execute(
+        'create index if not exists jobs_project on jobs (project_id, state)')
+
+    # every pushed commit and the run it was merged into, to recognize webhook retries
+    db.execute('''create table if not exists pushes (
+        project_id integer not null,
+        checkout_sha text not null,
+        run_id text not null,
+        received_at real not null,
+        primary key (project_id, checkout_sha)
+    )''')
+    return db
+
+
+def start(handler: Callable[[str, Dict[str, Any]], None]):
+    """Open the queue, requeue jobs interrupted by a restart and start the workers"""
+    global _queue, _handler
+    queue_settings = _get_queue_settings()
+
+    _queue = state_db.WorkQueue(_open(queue_settings['path']), 'jobs',
+                                order_column='enqueued_at', started_column='started_at')
+    _handler = handler
+
+    requeued = _queue.requeue_running()
+    if requeued > 0:
+        log(f'Requeued {requeued} runs interrupted by a restart')
+
+    _queue.delete_finished(['done', 'failed'], RETENTION)
+    with _queue.cond:
+        _queue.db.execute('delete from pushes where received_at < ?',
+                          (time.time() - RETENTION,))
+
+    for i in range(queue_settings['workers']):
+        threading.Thread(target=_work, name=f'secd-worker-{i}',
+                         daemon=True).start()
+
+    log(f"Started run queue with {queue_settings['workers']} workers at {queue_settings['path']}")
+
+
+def find_run(project_id: int, checkout_sha: str) -> str:
+    """Get the run a commit was already queued in, or None"""
+    with _queue.cond:
+        return _find_run(project_id, checkout_sha)
+
+
+def _find_run(project_id: int, checkout_sha: str) -> str:
+    # a commit whose run failed may be pushed again
+    row = _queue.db.execute("""select pushes.run_id from pushes join jobs on jobs.run_id = pushes.run_id
+        where pushes.project_id = ? and pushes.checkout_sha = ? and jobs.state != 'failed'""",
+                      (project_id, checkout_sha)).fetchone()
+    return row[0] if row is not None else None
+
+
+def enqueue(run_id: str, payload: Dict[str, Any]) -> Tuple[str, str]:
+    """Add a push to the queue, returns the run it belongs to and how it was added.
+
+    A push of a project that still has a run of the same user waiting in the
+    debounce window replaces the payload of that run instead of adding a new
+    one, so a burst of pushes is launched once with the latest commit. The outcome is one of
+    queued, coalesced, duplicate or full, the run is None when full."""
+    project_id = payload['project_id']
+    user_id = payload['user_id']
+    checkout_sha = payload['checkout_sha']
+    queue_settings = _get_queue_settings()
+    now = time.time()
+
+    with _queue.cond:
+        existing = _find_run(project_id, checkout_sha)
+        if existing is not None:
+            outcome = (existing, 'duplicate')
+        else:
+            waiting = _queue.db.execute("""select run_id from jobs
+                where project_id = ? and user_id = ? and state = 'queued' and not_before > ?""",
+                                        (project_id, user_id, now)).fetchone()
+            if waiting is not None:
+                # debounce, the window restarts with every push
+                _queue.db.execute('update jobs set payload = ?, not_before = ? where run_id = ?',
+                                  (json.dumps(payload), now + queue_settings['debounce'], waiting[0]))
+                outcome = (waiting[0], 'coalesced')
+            else:
+                (size,) = _queue.db.execute(
+                    "select count(*) from jobs where state in ('queued', 'running')").fetchone()
+                if size >= queue_settings['maxSize']:
+                    outcome = (None, 'full')
+                else:
+                    _queue.db.execute('''insert into jobs (run_id, payload, state, enqueued_at, project_id, user_id, not_before)
+                        values (?, ?, 'queued', ?, ?, ?, ?)''',
+                                      (run_id, json.dumps(payload), now, project_id, user_id, now + queue_settings['debounce']))
+                    outcome = (run_id, 'queued')
+
+            if outcome[0] is not None:
+                _queue.db.execute('insert or replace into pushes (project_id, checkout_sha, run_id, received_at) values (?, ?, ?, ?)',
+                                  (project_id, checkout_sha, outcome[0], now))
+                _queue.cond.notify()
+
+    metrics.PUSHES.labels(outcome[1]).inc()
+    return outcome
+
+
+def get_stats() -> Dict[str, Any]:
+    now = time.time()
+    with _queue.cond:
+        counts = dict(_queue.db.execute(
+            'select state, count(*) from jobs group by state').fetchall())
+        (oldest,) = _queue.db.execute(
+            "select min(enqueued_at) from jobs where state = 'queued'").fetchone()
+        (avg_wait,) = _queue.db.execute(
+            '''select avg(started_at - enqueued_at) from (
+                select started_at, enqueued_at from jobs where started_at is not null
+                order by started_at desc limit 100)''').fetchone()
+
+    return {
+        'depth': counts.get('queued', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'max_size': _get_queue_settings()['maxSize'],
+        'oldest_wait_seconds': now - oldest if oldest is not None else 0.0,
+        'avg_wait_seconds': avg_wait or 0.0,
+    }
+
+
+def _work():
+    while True:
+        run_id, payload, enqueued_at, started_at = _queue.claim(['run_id', 'payload', 'enqueued_at'])
+        payload = json.loads(payload)
+        tracing.record(run_id, 'queue', enqueued_at, started_at)
+        try:
+            with log_context(run_id=run_id, project_id=payload.get('project_id'), user_id=payload.get('user_id')):
+                _handler(run_id, payload)
+        except Exception as e:
+            log(f'Run {run_id} failed. Details: {e}', "ERROR")
+            _queue.finish(run_id, str(e))
+        else:
+            _queue.finish(run_id)
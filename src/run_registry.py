@@ -0,0 +1,210 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+import src.k8s_service as k8s_service
+import src.state_db as state_db
+
+from typing import Any, Dict, List
+from src.logger import log
+
+# A run moves through these states in order, failed ends a launch early
+STATES = ['queued', 'cloning', 'building',
+          'running', 'finalizing', 'done', 'failed']
+
+# States a run never leaves
+TERMINAL_STATES = ['done', 'failed']
+
+# States in which a run has resources in the cluster
+ACTIVE_STATES = ['running']
+
+# Columns that can be set together with a state
+FIELDS = ['project_id', 'gitlab_user_id', 'user_id', 'checkout_sha', 'namespace',
+          'resources', 'image', 'db_user', 'deadline', 'reason', 'error']
+
+# Finished runs are kept this long
+RETENTION = 30 * 24 * 60 * 60
+
+_lock = threading.Lock()
+_db: sqlite3.Connection = None
+
+
+def _open(path: str) -> sqlite3.Connection:
+    db = state_db.connect(path)
+    db.execute('''create table if not exists runs (
+        run_id text primary key,
+        state text not null,
+        project_id integer,
+        gitlab_user_id integer,
+        user_id text,
+        checkout_sha text,
+        namespace text,
+        resources text,
+        image text,
+        db_user text,
+        deadline real,
+        reason text,
+        error text,
+        state_times text not null,
+        created_at real not null,
+        updated_at real not null
+    )''')
+    db.execute(
+        'create index if not exists runs_user on runs (user_id, state)')
+    db.execute(
+        'create index if not exists runs_project on runs (project_id, state)')
+    db.execute(
+        'create index if not exists runs_deadline on runs (deadline)')
+    return db
+
+
+def _with_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = _open(state_db.get_state_path('secd-runs.db'))
+    return _db
+
+
+def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    run = dict(row)
+    run['resources'] = json.loads(
+        run['resources']) if run['resources'] else []
+    run['state_times'] = json.loads(run['state_times'])
+    return run
+
+
+def register(run_id: str, **fields):
+    """Add a queued run"""
+    now = time.time()
+    with _lock:
+        _with_db().execute('''insert into runs (run_id, state, state_times, created_at, updated_at)
+            values (?, 'queued', ?, ?, ?) on conflict (run_id) do nothing''',
+                           (run_id, json.dumps({'queued': now}), now, now))
+        _update(run_id, fields, now)
+
+
+def set_state(run_id: str, state: str, **fields):
+    """Move a run to state and record when it did, fields are any of FIELDS.
+
+    Raises if the run is done or failed and state is another state"""
+    if state not in STATES:
+        raise Exception(f'Unknown run state {state}')
+
+    now = time.time()
+    with _lock:
+        db = _with_db()
+        row = db.execute(
+            'select state, state_times from runs where run_id = ?', (run_id,)).fetchone()
+        if row is None:
+            db.execute('''insert into runs (run_id, state, state_times, created_at, updated_at)
+                values (?, ?, '{}', ?, ?)''', (run_id, state, now, now))
+            state_times = {}
+        elif row[0] in TERMINAL_STATES and row[0] != state:
+            raise Exception(f'Run {run_id} is {row[0]}, it can not move to {state}')
+        else:
+            state_times = json.loads(row[1])
+
+        state_times[state] = now
+        db.execute('update runs set state = ?, state_times = ? where run_id = ?',
+                   (state, json.dumps(state_times), run_id))
+        _update(run_id, fields, now)
+
+
+def update(run_id: str, **fields):
+    """Set fields of a run without changing its state"""
+    with _lock:
+        _update(run_id, fields, time.time())
+
+
+def _update(run_id: str, fields: Dict[str, Any], now: float):
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise Exception(f'Unknown run fields {", ".join(unknown)}')
+
+    if 'resources' in fields:
+        fields = dict(fields, resources=json.dumps(fields['resources']))
+
+    assignments = ''.join(f', {field} = ?' for field in fields)
+    _with_db().execute(f'update runs set updated_at = ?{assignments} where run_id = ?',
+                       (now, *fields.values(), run_id))
+
+
+def get(run_id: str) -> Dict[str, Any]:
+    with _lock:
+        cursor = _with_db().cursor()
+        cursor.row_factory = sqlite3.Row
+        row = cursor.execute(
+            'select * from runs where run_id = ?', (run_id,)).fetchone()
+
+    return _to_dict(row) if row is not None else None
+
+
+def find(user_id: str = None, project_id: int = None, states: List[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    """Newest runs matching every given filter"""
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if project_id is not None:
+        conditions.append('project_id = ?')
+        params.append(project_id)
+    if states is not None:
+        conditions.append(f'state in ({", ".join("?" for _ in states)})')
+        params.extend(states)
+
+    where = f'where {" and ".join(conditions)}' if conditions else ''
+    with _lock:
+        cursor = _with_db().cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(f'select * from runs {where} order by created_at desc limit ?',
+                              (*params, limit)).fetchall()
+
+    return [_to_dict(row) for row in rows]
+
+
+def get_active_run_ids(user_id: str, project_id: int = None) -> List[str]:
+    """Runs of a user that have resources in the cluster, only those of project_id if given"""
+    return [run['run_id'] for run in find(user_id=user_id, project_id=project_id, states=ACTIVE_STATES, limit=-1)]
+
+
+def reconcile(namespaces: List, listed_at: float) -> List[str]:
+    """Match the registry with the run namespaces in the cluster listed at listed_at, returns
+    runs that lost their namespace.
+
+    Namespaces the registry does not know, created before it existed or while
+    it was unavailable, are added as running."""
+    listed = {}
+    for namespace in namespaces:
+        run_id = k8s_service.get_run_id(namespace.metadata.name)
+        listed[run_id] = namespace
+
+    with _lock:
+        db = _with_db()
+        db.execute("delete from runs where state in ('done', 'failed') and updated_at < ?",
+                   (time.time() - RETENTION,))
+        known = set(row[0] for row in db.execute('select run_id from runs'))
+        # runs launched after the namespaces were listed are not lost
+        active = [row[0] for row in db.execute(
+            f'select run_id from runs where state in ({", ".join("?" for _ in ACTIVE_STATES)}) and updated_at < ?',
+            (*ACTIVE_STATES, listed_at))]
+
+    lost = [run_id for run_id in active if run_id not in listed]
+
+    for run_id, namespace in listed.items():
+        if run_id in known:
+            continue
+
+        annotations = namespace.metadata.annotations or {}
+        deadline = None
+        if 'rununtil' in annotations:
+            deadline = datetime.datetime.fromisoformat(
+                annotations['rununtil']).timestamp()
+
+        log(f"Registering run {run_id} found in the cluster", run_id=run_id)
+        set_state(run_id, 'running', user_id=annotations.get('userid'),
+                  namespace=namespace.metadata.name, deadline=deadline)
+
+    return lost
@@ -1,23 +1,90 @@
 import falcon
-import json
+import hmac
+import orjson
+import prometheus_client
 import uuid
-import shutil
 import threading
-import os
-import datetime
 
 import src.gitlab_service as gitlab_service
-import src.keycloak_service as keycloak_service
-import src.mysql_service as mysql_service
 import src.docker_service as docker_service
-import src.k8s_service as k8s_service
+import src.finalizer as finalizer
+import src.gpu_scheduler as gpu_scheduler
+import src.identity_service as identity_service
+import src.metrics as metrics
+import src.launcher as launcher
+import src.run_queue as run_queue
+import src.run_registry as run_registry
+import src.tracing as tracing
 import src.daemon as daemon
 
-from wsgiref.simple_server import make_server
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from typing import Any, Dict
+from wsgiref.simple_server import WSGIServer, make_server
 from cerberus import Validator
 
 from src.setup import get_settings
-from src.logger import log
+from src.logger import log, log_context
+
+
+HOOK_SCHEMA = {
+    'event_name': {'type': 'string', 'required': True},
+    'ref': {'type': 'string', 'required': True},
+    'checkout_sha': {'type': 'string', 'required': True},
+    'user_id': {'type': 'integer', 'required': True},
+    'project_id': {'type': 'integer', 'required': True},
+    'project': {
+        'type': 'dict',
+        'required': True,
+        'schema': {
+            'http_url': {'type': 'string', 'required': True},
+            'path_with_namespace': {'type': 'string', 'required': True},
+        }
+    },
+    'commits': {
+        'type': 'list',
+        'required': True,
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'type': 'string', 'required': True},
+            }
+        }
+    }
+}
+
+# Validators are not thread-safe, so every server thread gets its own
+# instance. The schema itself is only compiled by the first one.
+_validators = threading.local()
+
+
+def _get_hook_validator() -> Validator:
+    if not hasattr(_validators, 'hook'):
+        _validators.hook = Validator(HOOK_SCHEMA, allow_unknown=True)
+
+    return _validators.hook
+
+
+def _get_server_settings() -> Dict[str, Any]:
+    server_settings = get_settings().get('server', {})
+    return {
+        'port': server_settings.get('port', 8080),
+        'threads': server_settings.get('threads', 16),
+        'maxBodySize': server_settings.get('maxBodySize', 5 * 1024 * 1024),
+    }
+
+
+def _check_limits(run_meta: Dict[str, Any]) -> str:
+    """Check run metadata against the configured limits, returns why it is not allowed or None"""
+    limits = get_settings().get('limits', {})
+
+    if 'maxRunFor' in limits and run_meta['runfor'] > limits['maxRunFor']:
+        return f"runfor {run_meta['runfor']} is longer than the maximum of {limits['maxRunFor']} hours"
+
+    if run_meta['gpu'] and not limits.get('gpu', True):
+        return 'GPU runs are not available'
+
+    return None
 
 
 class HookResource:
@@ -35,46 +102,45 @@ class HookResource:
                 description='Invalid token'
             )
 
+        # reject oversized payloads before reading them
+        max_body_size = _get_server_settings()['maxBodySize']
+        if req.content_length is not None and req.content_length > max_body_size:
+            raise falcon.HTTPError(
+                falcon.HTTP_413,
+                title='Payload too large',
+                description=f'Body is larger than {max_body_size} bytes'
+            )
+
         # parse body
-        body_raw = req.bounded_stream.read()
+        body_raw = req.bounded_stream.read(max_body_size + 1)
         if not body_raw:
             raise falcon.HTTPBadRequest(
                 title='Bad request',
                 description='Missing body'
             )
 
+        if len(body_raw) > max_body_size:
+            raise falcon.HTTPError(
+                falcon.HTTP_413,
+                title='Payload too large',
+                description=f'Body is larger than {max_body_size} bytes'
+            )
+
         try:
-            body = json.loads(body_raw)
+            body = orjson.loads(body_raw)
         except:
             raise falcon.HTTPBadRequest(
                 title='Bad request',
                 description='Invalid body'
             )
 
-        validation = {
-            'event_name': {'type': 'string'},
-            'ref': {'type': 'string'},
-            'user_id': {'type': 'integer'},
-            'project_id': {'type': 'integer'},
-            'project': {
-                'type': 'dict',
-                'schema': {
-                    'http_url': {'type': 'string'},
-                }
-            },
-            'commits': {
-                'type': 'list',
-                'schema': {
-                    'type': 'dict',
-                    'schema': {
-                        'id': {'type': 'string'},
-                    }
-                }
-            }
-        }
+        if not isinstance(body, dict):
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description='Invalid body'
+            )
 
-        v = Validator(validation)
-        v.allow_unknown = True
+        v = _get_hook_validator()
         if not v.validate(body):
             raise falcon.HTTPBadRequest(
                 title='Bad request',
@@ -95,11 +161,30 @@ class HookResource:
                 description=f'Commit is not from main branch: {body["ref"]}'
             )
 
+        with log_context(project_id=body['project_id'], user_id=body['user_id'], stage='webhook'), \
+                tracing.start_trace('webhook', project_id=body['project_id'], user_id=body['user_id'],
+                                    checkout_sha=body['checkout_sha']):
+            self._accept(body, resp)
+
+    def _accept(self, body, resp):
+        """Check the commits and the tree of a validated push and queue a run for it"""
+        # GitLab retries a hook it did not get a response for in time
+        run_id = run_queue.find_run(body['project_id'], body['checkout_sha'])
+        if run_id is not None:
+            log(f'Commit {body["checkout_sha"]} is already queued in run {run_id}', run_id=run_id)
+            metrics.PUSHES.labels('duplicate').inc()
+            tracing.bind(run_id, outcome='duplicate')
+            resp.status = falcon.HTTP_200
+            resp.media = {'run_id': run_id, 'duplicate': True}
+            return
+
         log(f'Found {len(body["commits"])} commits - {body["project"]["path_with_namespace"]}')
+        with metrics.STAGE_SECONDS.labels('signatures').time(), tracing.span('signatures'):
+            signatures = gitlab_service.get_signatures(
+                body['project_id'], [push_commit['id'] for push_commit in body['commits']])
         for push_commit in body['commits']:
 
-            signature = gitlab_service.get_signature(
-                body['project_id'], push_commit['id'])
+            signature = signatures[push_commit['id']]
             if signature is None:
                 raise falcon.HTTPBadRequest(
                     title='Bad request',
@@ -112,119 +197,255 @@ class HookResource:
 
         log(f'All {len(body["commits"])} commits have a verified signature')
 
-        # check if the project has a Dockerfile
-        if not gitlab_service.has_file_in_repo(body['project_id'], 'Dockerfile', body['ref']):
+        # check the pushed commit before anything is cloned or built
+        with metrics.STAGE_SECONDS.labels('preflight').time(), tracing.span('preflight'):
+            preflight = gitlab_service.get_preflight(
+                body['project_id'], body['checkout_sha'])
+        if preflight['error'] is not None:
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description=preflight['error']
+            )
+
+        if 'Dockerfile' not in preflight['files']:
             raise falcon.HTTPBadRequest(
                 title='Bad request',
                 description=f'No Dockerfile found in project {body["project_id"]}'
             )
 
-        def create():
-            try:
-                # Find keycloak user id
-                gitlab_user_id = body['user_id']
-                keycloak_user_id = gitlab_service.get_idp_user_id(
-                    gitlab_user_id)
-
-                # fetch keycloak user groups
-                keycloak_groups = keycloak_service.get_keycloak_user_groups(
-                    keycloak_user_id)
-
-                # create db user with groups
-                mysql_groups = []
-                for group in keycloak_groups:
-                    prefix = '/mysql_'
-                    if group['path'].startswith(prefix):
-                        mysql_groups.append(group['path'][len(prefix):])
-
-                db_user, db_pass = mysql_service.create_mysql_user(
-                    mysql_groups)
-
-                # Run ID
-                run_id = str(uuid.uuid4()).replace('-', '')
-
-                # Clone repo
-                repo_path = f"{get_settings()['path']['repoPath']}/{run_id}"
-                gitlab_service.clone(body["project"]["http_url"], repo_path)
-
-                # Create an output folder for the run
-                date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                output_path = f'{repo_path}/outputs/{date}-{run_id}'
-                os.makedirs(output_path)
-
-                # Get runfor
-                run_meta = gitlab_service.get_metadata(f"{repo_path}/secd.yml")
-                run_for = run_meta['runfor']
-                gpu = run_meta['gpu']
-
-                # Build image
-                reg_settings = get_settings()['registry']
-                image_name = f"{reg_settings['url']}/{reg_settings['project']}/{run_id}"
-                docker_service.build_image(repo_path, image_name)
-                docker_service.push_and_remove_image(image_name)
-
-                # Create namespace and output volume
-                pvc_repo_path = get_settings()['k8s']['pvcPath']
-                k8s_service.create_namespace(keycloak_user_id, run_id, run_for)
-                k8s_service.create_persistent_volume(
-                    run_id, f'{pvc_repo_path}/repos/{run_id}/outputs/{date}-{run_id}')
-
-                # Check if cache_dir exists, then create the cache volume and mount the mount_path
-                cache_dir = None
-                mount_path = None
-                if "cache_dir" in run_meta and run_meta["cache_dir"]:
-                    # Default mount_path inside container
-                    mount_path = '/cache'
-                    
-                    # Find and fetch custom mount_path if specified
-                    if "mount_path" in run_meta and run_meta["mount_path"]:
-                        mount_path = run_meta['mount_path']
-                        log(f"Found custom mount_path: {mount_path}")
-                    
-                    # Fetch cache_dir
-                    cache_dir = run_meta['cache_dir']
-                    cache_path = f"{get_settings()['path']['cachePath']}/{keycloak_user_id}/{cache_dir}"
-                    log(f"Found cache_dir: {cache_path}")
-
-                    # Create cache_dir if not exists
-                    if not os.path.exists(cache_path):
-                        os.makedirs(cache_path)
-
-                    # Create PVC for cache_dir
-                    k8s_service.create_persistent_volume(
-                        run_id, f'{pvc_repo_path}/cache/{keycloak_user_id}/{cache_dir}', "cache")
-                
-                # Create pod
-                k8s_service.create_pod(run_id, image_name, {
-                    "DB_USER": db_user,
-                    "DB_PASS": db_pass,
-                    "DB_HOST": 'mysql.mysql.svc.cluster.local',
-                    "OUTPUT_PATH": '/output',
-                    "SECD": 'PRODUCTION'
-                }, gpu, mount_path)
-
-            except Exception as e:
-                log(str(e), "ERROR")
-            else:
-                log(f"Successfully launched {run_id}")
-
-        threading.Thread(target=create).start()
-
-        # Commit is ok, return 200
-        resp.status = falcon.HTTP_200
-
-
-app = falcon.App()
+        limits_error = _check_limits(preflight['metadata'])
+        if limits_error is not None:
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description=limits_error
+            )
+
+        run_id, outcome = run_queue.enqueue(
+            str(uuid.uuid4()).replace('-', ''), body)
+        if run_id is not None:
+            tracing.bind(run_id, outcome=outcome)
+        if outcome == 'full':
+            raise falcon.HTTPTooManyRequests(
+                title='Too many requests',
+                description='Run queue is full'
+            )
+
+        if outcome == 'duplicate':
+            log(f'Commit {body["checkout_sha"]} is already queued in run {run_id}', run_id=run_id)
+            resp.status = falcon.HTTP_200
+            resp.media = {'run_id': run_id, 'duplicate': True}
+            return
+
+        if outcome == 'coalesced':
+            run_registry.update(run_id, checkout_sha=body['checkout_sha'])
+            log(f'Coalesced commit {body["checkout_sha"]} into queued run {run_id}', run_id=run_id)
+        else:
+            run_registry.register(run_id, project_id=body['project_id'], gitlab_user_id=body['user_id'],
+                                  checkout_sha=body['checkout_sha'])
+            log(f'Queued run {run_id}', run_id=run_id)
+
+        # Commit is ok, return 202 with the queued run
+        resp.status = falcon.HTTP_202
+        resp.media = {'run_id': run_id}
+
+
+def _check_admin_token(req):
+    admin_token = get_settings().get('admin', {}).get('token')
+    if admin_token is None or not hmac.compare_digest(req.get_header('Authorization') or '', f'Bearer {admin_token}'):
+        raise falcon.HTTPUnauthorized(
+            title='Unauthorized',
+            description='Invalid token'
+        )
+
+
+class IdentitiesResource:
+    def on_get(self, req, resp):
+        _check_admin_token(req)
+        resp.media = identity_service.get_stats()
+
+    def on_delete(self, req, resp):
+        _check_admin_token(req)
+        identity_service.invalidate()
+        resp.status = falcon.HTTP_204
+
+
+class IdentityResource:
+    def on_delete(self, req, resp, gitlab_user_id):
+        _check_admin_token(req)
+        identity_service.invalidate(gitlab_user_id=gitlab_user_id)
+        resp.status = falcon.HTTP_204
+
+
+class KeycloakEventResource:
+    def on_post(self, req, resp):
+        """Forget cached groups of the user a Keycloak (admin) event is about"""
+        _check_admin_token(req)
+
+        event = req.get_media(default_when_empty=None)
+        if not isinstance(event, dict):
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description='Invalid body'
+            )
+
+        keycloak_user_id = event.get('userId')
+        resource_path = event.get('resourcePath') or ''
+        if resource_path.startswith('users/'):
+            keycloak_user_id = resource_path.split('/')[1]
+
+        if keycloak_user_id is not None:
+            identity_service.invalidate(keycloak_user_id=keycloak_user_id)
+
+        resp.status = falcon.HTTP_204
+
+
+class RunTraceResource:
+    def on_get(self, req, resp, run_id):
+        _check_admin_token(req)
+        trace = tracing.get_trace(run_id)
+        if trace is None:
+            raise falcon.HTTPNotFound(
+                title='Not found',
+                description=f'No trace found for run {run_id}'
+            )
+
+        trace_format = req.get_param('format', default='json')
+        if trace_format == 'otlp':
+            resp.media = tracing.to_otlp(trace)
+        elif trace_format == 'chrome':
+            resp.media = tracing.to_chrome(trace)
+        elif trace_format == 'json':
+            resp.media = trace
+        else:
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description='format must be one of json, otlp, chrome'
+            )
+
+
+class RunBuildResource:
+    def on_get(self, req, resp, run_id):
+        _check_admin_token(req)
+        report = docker_service.get_report(run_id)
+        if report is None:
+            raise falcon.HTTPNotFound(
+                title='Not found',
+                description=f'No build report found for run {run_id}'
+            )
+
+        resp.media = report
+
+
+class MetricsResource:
+    def on_get(self, req, resp):
+        resp.content_type = prometheus_client.CONTENT_TYPE_LATEST
+        resp.data = prometheus_client.generate_latest()
+
+
+class FinalizationsResource:
+    def on_get(self, req, resp):
+        _check_admin_token(req)
+        resp.media = finalizer.get_status()
+
+
+class FinalizationRetryResource:
+    def on_post(self, req, resp, run_id):
+        _check_admin_token(req)
+        if not finalizer.retry(run_id):
+            raise falcon.HTTPNotFound(
+                title='Not found',
+                description=f'No failed finalization found for run {run_id}'
+            )
+
+        resp.status = falcon.HTTP_202
+
+
+class RunsResource:
+    def on_get(self, req, resp):
+        _check_admin_token(req)
+        states = req.get_param_as_list('state')
+        if states is not None and any(state not in run_registry.STATES for state in states):
+            raise falcon.HTTPBadRequest(
+                title='Bad request',
+                description=f'state must be one of {", ".join(run_registry.STATES)}'
+            )
+
+        resp.media = run_registry.find(
+            user_id=req.get_param('user_id'),
+            project_id=req.get_param_as_int('project_id'),
+            states=states,
+            limit=req.get_param_as_int('limit', min_value=1, max_value=1000, default=100))
+
+
+class RunResource:
+    def on_get(self, req, resp, run_id):
+        _check_admin_token(req)
+        run = run_registry.get(run_id)
+        if run is None:
+            raise falcon.HTTPNotFound(
+                title='Not found',
+                description=f'No run found with id {run_id}'
+            )
+
+        resp.media = run
+
+
+class GpuQueueResource:
+    def on_get(self, req, resp):
+        _check_admin_token(req)
+        resp.media = gpu_scheduler.get_queue()
+
+
+class QueueResource:
+    def on_get(self, req, resp):
+        _check_admin_token(req)
+        resp.media = run_queue.get_stats()
+
+
+app = falcon.App(middleware=[metrics.HttpMetricsMiddleware()])
 app.add_route('/v1/hook', HookResource())
+app.add_route('/v1/queue', QueueResource())
+app.add_route('/v1/gpu/queue', GpuQueueResource())
+app.add_route('/metrics', MetricsResource())
+app.add_route('/v1/finalizations', FinalizationsResource())
+app.add_route('/v1/finalizations/{run_id}/retry', FinalizationRetryResource())
+app.add_route('/v1/runs', RunsResource())
+app.add_route('/v1/runs/{run_id}', RunResource())
+app.add_route('/v1/runs/{run_id}/build', RunBuildResource())
+app.add_route('/v1/runs/{run_id}/trace', RunTraceResource())
+app.add_route('/v1/identities', IdentitiesResource())
+app.add_route('/v1/identities/{gitlab_user_id:int}', IdentityResource())
+app.add_route('/v1/keycloak/events', KeycloakEventResource())
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI server that handles requests on a bounded thread pool"""
+    daemon_threads = True
+    pool: ThreadPoolExecutor = None
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
 
 
 def run():
+    # Start the workers that launch queued runs and push results of finished runs
+    run_queue.start(launcher.create)
+    finalizer.start()
+
     # Run daemon.run() in a new thread
     daemon_thread = threading.Thread(target=daemon.run)
     daemon_thread.start()
 
-    with make_server('', 8080, app) as httpd:
-        log('Serving on port 8080...')
+    server_settings = _get_server_settings()
+    PooledWSGIServer.pool = ThreadPoolExecutor(
+        max_workers=server_settings['threads'], thread_name_prefix='secd-http')
+
+    with make_server('', server_settings['port'], app, server_class=PooledWSGIServer) as httpd:
+        log(f"Serving on port {server_settings['port']} with {server_settings['threads']} threads...")
 
         # Serve until process is killed
         httpd.serve_forever()
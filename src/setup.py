@@ -1,35 +1,153 @@
 import yaml
 import os
+import threading
+import time
+import types
 
+import src.client_registry as client_registry
+
+from typing import Any, Mapping
 from cerberus import Validator
+from src.logger import log
+
+SCHEMA_FILE = 'settings-schema.yml'
+
+# Settings sections that configure a shared client, keyed by section. The
+# client is rebuilt when its section changes on reload.
+CLIENT_SECTIONS = {
+    'k8s': 'k8s',
+    'gitlab': 'gitlab',
+    'keycloak': 'keycloak',
+    'db': 'mysql',
+    'registry': 'docker',
+}
+
+# Settings only read when secd starts, as (section, key). A change is
+# logged on reload and takes effect on the next restart.
+RESTART_SETTINGS = [
+    ('server', 'port'),
+    ('server', 'threads'),
+    ('queue', 'path'),
+    ('queue', 'workers'),
+    ('finalizer', 'workers'),
+    ('path', 'statePath'),
+]
+
+# The current settings snapshot, replaced as a whole on reload so readers
+# never need a lock
+settings: Mapping[str, Any] = None
+
+_lock = threading.Lock()
+_validator: Validator = None
+_mtime: float = None
+_watcher: threading.Thread = None
 
 
-def get_settings():
-    """Get settings from config file"""
-    global settings
-    if settings == {}:
-        load_settings()
-    return settings
+def get_settings() -> Mapping[str, Any]:
+    """Get the current, read-only settings snapshot"""
+    current = settings
+    if current is None:
+        with _lock:
+            if settings is None:
+                _load()
+            current = settings
+    return current
 
 
 def load_settings():
     """Load settings from config file"""
+    with _lock:
+        _load()
+
+
+def reload_settings() -> bool:
+    """Reload settings if the config file changed, returns True if a new snapshot was loaded.
+
+    An invalid config file is logged and the current snapshot is kept."""
+    global _mtime
+    with _lock:
+        mtime = os.stat(_get_config_path()).st_mtime
+        if mtime == _mtime:
+            return False
+
+        try:
+            old = settings
+            _load()
+        except Exception as e:
+            # only retry once the file changes again
+            _mtime = mtime
+            log(f'Error reloading settings, keeping the current settings. Details: {e}', "ERROR")
+            return False
+
+    for section, client_name in CLIENT_SECTIONS.items():
+        if old is not None and old.get(section) != settings.get(section):
+            client_registry.invalidate(client_name)
+
+    for section, key in RESTART_SETTINGS:
+        if old is not None and old.get(section, {}).get(key) != settings.get(section, {}).get(key):
+            log(f'Setting {section}.{key} changed, it takes effect on the next restart', "WARNING")
 
+    log('Reloaded settings')
+    return True
+
+
+def watch_settings(interval: float = 5):
+    """Reload settings in the background whenever the config file changes"""
+    global _watcher
+    if _watcher is not None:
+        return
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_settings()
+            except Exception as e:
+                log(f'Error watching settings. Details: {e}', "ERROR")
+
+    _watcher = threading.Thread(
+        target=watch, name='secd-settings', daemon=True)
+    _watcher.start()
+
+
+def _get_config_path() -> str:
     env_name = "CONFIG_FILE"
     if env_name not in os.environ:
         raise Exception(f'{env_name} is not set')
-    else:
-        config_path = os.environ[env_name]
+    return os.environ[env_name]
 
-    yaml_file = open(config_path, 'r')
-    loaded_yaml = yaml.load(yaml_file, Loader=yaml.FullLoader)
+
+def _get_validator() -> Validator:
+    # the schema is only parsed once, callers hold _lock
+    global _validator
+    if _validator is None:
+        with open(SCHEMA_FILE, 'r') as schema_file:
+            schema = yaml.load(schema_file, Loader=yaml.FullLoader)
+        _validator = Validator(schema)
+    return _validator
+
+
+def _load():
+    global settings, _mtime
+    config_path = _get_config_path()
+
+    # stat before reading so a write during the read triggers another reload
+    mtime = os.stat(config_path).st_mtime
+    with open(config_path, 'r') as yaml_file:
+        loaded_yaml = yaml.load(yaml_file, Loader=yaml.FullLoader)
 
     # match against schema
-    schema = yaml.load(open('settings-schema.yml', 'r'),
-                       Loader=yaml.FullLoader)
-    v = Validator(schema)
+    v = _get_validator()
     if not v.validate(loaded_yaml):
         raise Exception(f'Invalid config file: {v.errors}')
 
-    global settings
-    settings = loaded_yaml
+    settings = _freeze(loaded_yaml)
+    _mtime = mtime
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, List, Tuple
+from src.setup import get_settings
+
+
+def get_state_path(file_name: str) -> str:
+    """Path of a state database, in path.statePath or else in repoPath"""
+    path_settings = get_settings()['path']
+    return f"{path_settings.get('statePath', path_settings['repoPath'])}/{file_name}"
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a state database in autocommit mode, to be shared by threads under a lock"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False,
+                         isolation_level=None)
+    db.execute('pragma journal_mode=wal')
+    return db
+
+
+class WorkQueue:
+    """Jobs in a table of a state database, keyed by run_id and claimed one at a time by worker threads.
+
+    A job is in queued_state until a worker claims it once its due_column
+    time has come, then 'running' and finally 'done' or 'failed'. The table
+    also has finished_at and error columns. Callers query db themselves
+    while holding cond, and notify cond when they queue a job."""
+
+    def __init__(self, db: sqlite3.Connection, table: str, queued_state: str = 'queued',
+                 due_column: str = 'not_before', order_column: str = None, started_column: str = None):
+        self.db = db
+        self.cond = threading.Condition()
+        self.table = table
+        self.queued_state = queued_state
+        self.due_column = due_column
+        self.order_column = order_column or due_column
+        self.started_column = started_column
+
+    def requeue_running(self) -> int:
+        """Queue the jobs of workers that were stopped by a restart again, returns how many"""
+        with self.cond:
+            return self.db.execute(f"update {self.table} set state = ? where state = 'running'",
+                                   (self.queued_state,)).rowcount
+
+    def delete_finished(self, states: List[str], retention: float):
+        """Delete jobs that finished in one of states more than retention seconds ago"""
+        with self.cond:
+            self.db.execute(f'''delete from {self.table}
+                where state in ({", ".join("?" for _ in states)}) and finished_at < ?''',
+                            (*states, time.time() - retention))
+
+    def claim(self, columns: List[str]) -> Tuple:
+        """Wait for the first due job and mark it running, returns its columns and the time it was claimed"""
+        with self.cond:
+            while True:
+                now = time.time()
+                job = self.db.execute(f'''select {", ".join(columns)} from {self.table}
+                    where state = ? and {self.due_column} <= ? order by {self.order_column} limit 1''',
+                                      (self.queued_state, now)).fetchone()
+                if job is not None:
+                    started = f', {self.started_column} = ?' if self.started_column else ''
+                    self.db.execute(f"update {self.table} set state = 'running'{started} where run_id = ?",
+                                    (*([now] if self.started_column else []), job[columns.index('run_id')]))
+                    return (*job, now)
+
+                (due,) = self.db.execute(f'select min({self.due_column}) from {self.table} where state = ?',
+                                         (self.queued_state,)).fetchone()
+                self.cond.wait(due - now if due else None)
+
+    def finish(self, run_id: str, error: str = None, **columns):
+        """Mark a job done, or failed with error, and set columns"""
+        self._update(run_id, dict(columns, state='failed' if error else 'done',
+                                  finished_at=time.time(), error=error))
+
+    def defer(self, run_id: str, due: float, **columns):
+        """Queue a job again from due on, such as a failed attempt that is retried later, and set columns"""
+        self._update(run_id, dict(columns, state=self.queued_state, **{self.due_column: due}))
+        with self.cond:
+            self.cond.notify()
+
+    def _update(self, run_id: str, columns: Dict[str, Any]):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self.cond:
+            self.db.execute(f'update {self.table} set {assignments} where run_id = ?',
+                            (*columns.values(), run_id))
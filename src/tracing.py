@@ -0,0 +1,260 @@
+import contextlib
+import contextvars
+import hashlib
+import os
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, List
+from src.setup import get_settings
+
+
+class Span:
+    def __init__(self, name: str, parent_id: str, attributes: Dict[str, Any], start: float = None):
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = start if start is not None else time.time()
+        self.end: float = None
+        self.error: str = None
+        self.thread = threading.current_thread().name
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'seconds': self.end - self.start,
+            'attributes': self.attributes,
+            'error': self.error,
+            'thread': self.thread,
+        }
+
+
+class _Trace:
+    def __init__(self):
+        self.run_id: str = None
+        self.spans: List[Span] = []
+        self.dropped = 0
+        # the trace of the run this trace was merged into by bind()
+        self.merged_into: '_Trace' = None
+
+
+# Spans of a run are kept in memory, the least recently updated traces are
+# dropped first.
+# A span is only recorded inside a trace, so calls made outside of a run,
+# such as watches, cost nothing.
+_lock = threading.Lock()
+_traces: 'OrderedDict[str, _Trace]' = OrderedDict()
+# the trace and the span new spans are nested in
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    'secd_trace', default=None)
+
+
+def _get_tracing_settings() -> Dict[str, Any]:
+    tracing_settings = get_settings().get('tracing', {})
+    return {
+        'maxRuns': tracing_settings.get('maxRuns', 1000),
+        'maxSpans': tracing_settings.get('maxSpans', 2000),
+    }
+
+
+def _store(run_id: str, trace: _Trace):
+    """Callers hold _lock"""
+    trace.run_id = run_id
+    _traces[run_id] = trace
+    max_runs = _get_tracing_settings()['maxRuns']
+    while len(_traces) > max_runs:
+        _traces.popitem(last=False)
+
+
+def _get_trace(run_id: str) -> _Trace:
+    """Callers hold _lock"""
+    trace = _traces.get(run_id)
+    if trace is None:
+        trace = _Trace()
+        _store(run_id, trace)
+    else:
+        _traces.move_to_end(run_id)
+    return trace
+
+
+def _add(trace: _Trace, span: Span):
+    with _lock:
+        while trace.merged_into is not None:
+            trace = trace.merged_into
+        if len(trace.spans) >= _get_tracing_settings()['maxSpans']:
+            trace.dropped += 1
+            return
+        trace.spans.append(span)
+
+
+@contextlib.contextmanager
+def _enter(trace: _Trace, span: Span):
+    token = _current.set((trace, span))
+    try:
+        yield span
+    except BaseException as e:
+        span.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time()
+        _add(trace, span)
+
+
+@contextlib.contextmanager
+def start_trace(name: str, **attributes):
+    """Time a block as the root span of a trace that is only kept once bind() gives it a run"""
+    span = Span(name, None, attributes)
+    with _enter(_Trace(), span):
+        yield span
+
+
+def bind(run_id: str, **attributes):
+    """Keep the current trace as the trace of run_id, merging it into any trace the run already has.
+
+    attributes are set on the current span"""
+    current = _current.get()
+    if current is None:
+        return
+
+    trace, current_span = current
+    current_span.set(**attributes)
+    with _lock:
+        if trace.run_id is not None:
+            return
+        existing = _traces.get(run_id)
+        if existing is None:
+            _store(run_id, trace)
+        else:
+            # a push coalesced into a queued run, or a retried hook
+            room = max(_get_tracing_settings()['maxSpans'] - len(existing.spans), 0)
+            existing.spans.extend(trace.spans[:room])
+            existing.dropped += trace.dropped + len(trace.spans[room:])
+            trace.merged_into = existing
+            trace.run_id = run_id
+            _traces.move_to_end(run_id)
+
+
+@contextlib.contextmanager
+def span(name: str, run_id: str = None, **attributes):
+    """Time a block as a span nested in the current span.
+
+    With run_id the span goes to that run's trace, as a root span unless the
+    current span belongs to the same run. Without run_id and outside of a
+    trace nothing is recorded."""
+    current = _current.get()
+    if run_id is not None:
+        with _lock:
+            trace = _get_trace(run_id)
+        parent_id = current[1].span_id if current is not None and current[0].run_id == run_id else None
+    elif current is not None:
+        trace, parent_id = current[0], current[1].span_id
+    else:
+        yield None
+        return
+
+    with _enter(trace, Span(name, parent_id, attributes)) as entered:
+        yield entered
+
+
+def record(run_id: str, name: str, start: float, end: float, parent_id: str = None, **attributes) -> str:
+    """Add a span of something that was observed after it happened, returns its span id"""
+    recorded = Span(name, parent_id, attributes, start)
+    recorded.end = end
+    with _lock:
+        trace = _get_trace(run_id)
+    _add(trace, recorded)
+    return recorded.span_id
+
+
+def get_trace(run_id: str) -> Dict[str, Any]:
+    """The spans of a run ordered by start, or None if it has no trace"""
+    with _lock:
+        trace = _traces.get(run_id)
+        if trace is None:
+            return None
+        spans = [recorded.to_dict() for recorded in trace.spans]
+        dropped = trace.dropped
+
+    spans.sort(key=lambda recorded: recorded['start'])
+    return {'run_id': run_id, 'dropped_spans': dropped, 'spans': spans}
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """A trace from get_trace() as OTLP JSON, as accepted by OpenTelemetry collectors, Jaeger and Tempo"""
+    trace_id = trace['run_id']
+    if not re.fullmatch(r'[0-9a-f]{32}', trace_id):
+        trace_id = hashlib.md5(trace_id.encode()).hexdigest()
+
+    spans = []
+    for recorded in trace['spans']:
+        otlp_span = {
+            'traceId': trace_id,
+            'spanId': recorded['span_id'],
+            'name': recorded['name'],
+            'kind': 1,
+            'startTimeUnixNano': str(int(recorded['start'] * 1e9)),
+            'endTimeUnixNano': str(int(recorded['end'] * 1e9)),
+            'attributes': [{'key': key, 'value': _otlp_value(value)}
+                           for key, value in dict(recorded['attributes'], thread=recorded['thread']).items()],
+        }
+        if recorded['parent_id'] is not None:
+            otlp_span['parentSpanId'] = recorded['parent_id']
+        if recorded['error'] is not None:
+            otlp_span['status'] = {'code': 2, 'message': recorded['error']}
+        spans.append(otlp_span)
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': 'secd'}},
+            {'key': 'secd.run_id', 'value': {'stringValue': trace['run_id']}},
+        ]},
+        'scopeSpans': [{'scope': {'name': 'secd'}, 'spans': spans}],
+    }]}
+
+
+def to_chrome(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """A trace from get_trace() in the Chrome trace event format, for chrome://tracing and Perfetto"""
+    thread_ids = {}
+    events = []
+    for recorded in trace['spans']:
+        if recorded['thread'] not in thread_ids:
+            thread_ids[recorded['thread']] = len(thread_ids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_ids[recorded['thread']],
+                           'args': {'name': recorded['thread']}})
+
+        args = dict(recorded['attributes'])
+        if recorded['error'] is not None:
+            args['error'] = recorded['error']
+        events.append({
+            'name': recorded['name'],
+            'cat': 'secd',
+            'ph': 'X',
+            'ts': recorded['start'] * 1e6,
+            'dur': (recorded['end'] - recorded['start']) * 1e6,
+            'pid': 1,
+            'tid': thread_ids[recorded['thread']],
+            'args': args,
+        })
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'run_id': trace['run_id']}}